@@ -0,0 +1,204 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from ledger import LedgerStore
+
+# Files that can be rebuilt from the partitions are not backed up
+# (UniqueID index, category cache, monthly rollups, Parquet mirror)
+EXCLUDED = ('_ids.sqlite', '_category_cache.sqlite', '_rollups.sqlite', '_parquet')
+
+KEEP_LAST = 30
+
+
+class BackupStore:
+    # Snapshots of a ledger directory in <ledger>_backups. Every file is stored once under
+    # the SHA-256 of its content (gzip-compressed) in objects/, and a snapshot is a small
+    # JSON list of path -> hash. The ledger is partitioned by month, so a normal import
+    # only adds the one or two month files it changed; everything else is shared with the
+    # previous snapshot. Files whose size and modification time match the previous
+    # snapshot are not even read again.
+    def __init__(self, ledger_dir, backup_dir=None):
+        self.ledger_dir = ledger_dir
+        self.backup_dir = backup_dir or f'{ledger_dir.rstrip("/")}_backups'
+        self.objects_dir = os.path.join(self.backup_dir, 'objects')
+        self.snapshots_dir = os.path.join(self.backup_dir, 'snapshots')
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def _snapshot_path(self, name):
+        return os.path.join(self.snapshots_dir, f'{name}.json')
+
+    ### SNAPSHOTS
+
+    def snapshots(self):
+        if not os.path.isdir(self.snapshots_dir):
+            return []
+        return sorted(file_name[:-5] for file_name in os.listdir(self.snapshots_dir) if file_name.endswith('.json'))
+
+    def read_snapshot(self, name):
+        with open(self._snapshot_path(name), 'r') as json_file:
+            return json.load(json_file)
+
+    def _ledger_files(self):
+        for file_name in sorted(os.listdir(self.ledger_dir)):
+            path = os.path.join(self.ledger_dir, file_name)
+            if os.path.isfile(path) and file_name not in EXCLUDED and not file_name.endswith('.tmp'):
+                yield file_name, path
+
+    def _store_object(self, path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as source:
+            for block in iter(lambda: source.read(1 << 20), b''):
+                digest.update(block)
+        digest = digest.hexdigest()
+
+        object_path = self._object_path(digest)
+        if not os.path.isfile(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            with open(path, 'rb') as source, gzip.open(object_path + '.tmp', 'wb') as target:
+                shutil.copyfileobj(source, target)
+            os.replace(object_path + '.tmp', object_path)
+            return digest, True
+        return digest, False
+
+    # Record the current state of the ledger. Returns the snapshot name, or None if nothing
+    # changed since the last snapshot.
+    def snapshot(self):
+        previous_names = self.snapshots()
+        previous = self.read_snapshot(previous_names[-1])['files'] if previous_names else {}
+
+        files = {}
+        added = 0
+        for file_name, path in self._ledger_files():
+            stat = os.stat(path)
+            entry = previous.get(file_name)
+            if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+                files[file_name] = entry
+                continue
+
+            digest, new_object = self._store_object(path)
+            files[file_name] = {'sha256': digest, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+            added += new_object
+
+        if previous_names and {name: entry['sha256'] for name, entry in files.items()} == {name: entry['sha256'] for name, entry in previous.items()}:
+            return None
+
+        name = time.strftime('%Y%m%d%H%M%S')
+        while name in previous_names:
+            name = f'{name}_'
+        os.makedirs(self.snapshots_dir, exist_ok=True)
+        with open(self._snapshot_path(name) + '.tmp', 'w') as json_file:
+            json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'files': files}, json_file, indent=4)
+        os.replace(self._snapshot_path(name) + '.tmp', self._snapshot_path(name))
+
+        print(f"Backup snapshot {name}: {len(files)} files, {added} new")
+        return name
+
+    ### RESTORE
+
+    # Put the ledger back into the state of a snapshot (default: the latest).
+    # Partitions that did not exist then are removed, and the rebuildable files are
+    # dropped so they are rebuilt from the restored partitions.
+    def restore(self, name=None, target_dir=None):
+        names = self.snapshots()
+        if not names:
+            raise ValueError(f"No backups in {self.backup_dir}")
+        name = name or names[-1]
+        files = self.read_snapshot(name)['files']
+        target_dir = target_dir or self.ledger_dir
+        os.makedirs(target_dir, exist_ok=True)
+
+        # Versions only ever go up, so derived outputs (Excel workbooks) see every restored
+        # partition as changed
+        current_versions = LedgerStore(target_dir).versions()
+
+        for file_name in os.listdir(target_dir):
+            path = os.path.join(target_dir, file_name)
+            if file_name in EXCLUDED or (os.path.isfile(path) and file_name not in files):
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+
+        for file_name, entry in files.items():
+            path = os.path.join(target_dir, file_name)
+            with gzip.open(self._object_path(entry['sha256']), 'rb') as source, open(path + '.tmp', 'wb') as target:
+                shutil.copyfileobj(source, target)
+            os.replace(path + '.tmp', path)
+
+        store = LedgerStore(target_dir)
+        manifest = store.read_manifest()
+        restored_versions = manifest.get('versions', {})
+        manifest['versions'] = {key: max(current_versions.get(key, 0), restored_versions.get(key, 0)) + 1 for key in store.partitions()}
+        store.write_manifest(manifest)
+
+        print(f"Restored snapshot {name} into {target_dir}")
+        return name
+
+    ### RETENTION
+
+    # Keep the newest keep_last snapshots (plus the newest one of each of the last keep_days
+    # days) and delete objects no remaining snapshot refers to
+    def prune(self, keep_last=KEEP_LAST, keep_days=0):
+        names = self.snapshots()
+        keep = set(names[-keep_last:]) if keep_last else set()
+        if keep_days:
+            newest_per_day = {}
+            for name in names:
+                newest_per_day[name[:8]] = name
+            keep |= set(sorted(newest_per_day.values())[-keep_days:])
+
+        removed = [name for name in names if name not in keep]
+        for name in removed:
+            os.remove(self._snapshot_path(name))
+
+        referenced = {entry['sha256'] for name in keep for entry in self.read_snapshot(name)['files'].values()}
+        deleted_objects = 0
+        if os.path.isdir(self.objects_dir):
+            for prefix in os.listdir(self.objects_dir):
+                for digest in os.listdir(os.path.join(self.objects_dir, prefix)):
+                    if digest not in referenced:
+                        os.remove(os.path.join(self.objects_dir, prefix, digest))
+                        deleted_objects += 1
+
+        if removed:
+            print(f"Removed {len(removed)} old snapshots and {deleted_objects} unused objects")
+        return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage incremental ledger backups")
+    parser.add_argument('ledger', help="ledger directory")
+    parser.add_argument('--backup-dir', help="backup directory (default: <ledger>_backups)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('snapshot', help="back up the current ledger")
+    subparsers.add_parser('list', help="list snapshots")
+    restore_parser = subparsers.add_parser('restore', help="restore a snapshot (default: the latest)")
+    restore_parser.add_argument('name', nargs='?')
+    restore_parser.add_argument('--target', help="restore into this directory instead of the ledger")
+    prune_parser = subparsers.add_parser('prune', help="apply the retention policy")
+    prune_parser.add_argument('--keep-last', type=int, default=KEEP_LAST)
+    prune_parser.add_argument('--keep-days', type=int, default=0)
+    args = parser.parse_args()
+
+    backups = BackupStore(args.ledger, args.backup_dir)
+    if args.command == 'snapshot':
+        backups.snapshot()
+    elif args.command == 'list':
+        for name in backups.snapshots():
+            files = backups.read_snapshot(name)['files']
+            print(f"{name}  {len(files):>4} files  {sum(entry['size'] for entry in files.values()):>12} bytes")
+    elif args.command == 'restore':
+        backups.restore(args.name, args.target)
+    elif args.command == 'prune':
+        backups.prune(args.keep_last, args.keep_days)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+import importlib.util
+
+import numpy as np
+import pandas as pd
+
+from currency import convert_currency_batch
+from pdf_extract import first_page_columns
+from unique_ids import build_unique_ids
+
+# Columns every extractor returns, in this order
+STATEMENT_COLUMNS = ['Date', 'Description', 'Amount', 'Amount_currency', 'Currency', 'Currency_Rate', 'Bank', 'UniqueID']
+
+HAS_PYARROW = importlib.util.find_spec('pyarrow') is not None
+HAS_CALAMINE = importlib.util.find_spec('python_calamine') is not None
+
+
+### BANK SPECIFIC STEPS
+
+def _wise_rows(df):
+    # Filter out unwanted rows
+    return df[(df['Status'] != 'CANCELLED') & (df['Target amount (after fees)'] != 0) & (df['Source amount (after fees)'] != 0)]
+
+
+def _wise_transform(df, converter):
+    # Set values based on 'Direction' column
+    directions = [df['Direction'] == 'IN', df['Direction'] == 'OUT', df['Direction'] == 'NEUTRAL']
+
+    def by_direction(incoming, outgoing, neutral):
+        choices = [pd.Series(choice, index=df.index).to_numpy(dtype=object) for choice in (incoming, outgoing, neutral)]
+        return np.select(directions, choices, default='')
+
+    df['Description'] = by_direction(df['Source name'], df['Target name'], 'Internal transfer')
+    df['Amount_currency'] = by_direction(df['Source amount (after fees)'], df['Target amount (after fees)'] * -1, 0)
+    df['Currency'] = by_direction(df['Source currency'], df['Target currency'], df['Target currency'])
+
+    # Create DKK amount and rate, resolving each (currency, date) pair only once
+    return convert_currency_batch(df, converter)
+
+
+def _skrill_transform(df, converter):
+    # Convert columns to numeric and replace non-numeric values with NaN
+    debit = pd.to_numeric(df['[-]'], errors='coerce')
+    credit = pd.to_numeric(df['[+]'], errors='coerce')
+    df['Amount'] = 0 - debit.fillna(0) + credit.fillna(0)
+    return df
+
+
+def _norwegian_rows(df):
+    return df[~df['Type'].isin(['Reserveret', 'Indbetaling'])]
+
+
+### REGISTRY
+
+# One entry per supported bank. Adding a bank is a matter of adding an entry here:
+#   reader      'csv', 'xlsx' or 'pdf'
+#   delimiter / encoding             CSV dialect
+#   table_column                     PDF only: tables without this column are skipped
+#   columns     source column -> internal name; only these columns are read
+#   dtypes      source column -> dtype to parse straight into
+#   decimal / thousands              number convention of the amount columns
+#   date_format format of the date column after renaming to 'Date'
+#   currency    fixed currency, when the statement has no currency column
+#   id_columns  internal columns hashed into UniqueID (omit when the bank provides an ID)
+#   rows        optional filter applied right after reading
+#   transform   optional function(df, converter) for bank specific logic
+# Text columns that feed id_columns (such as 'Saldo') are pinned to str, so the decimal and
+# thousands options never reinterpret them and the IDs stay byte-identical to the ledger.
+BANK_FORMATS = {
+    'Danske Bank': {
+        'reader': 'csv',
+        'delimiter': ';',
+        'encoding': 'ISO-8859-1',
+        'columns': {'Dato': 'Date', 'Tekst': 'Description', 'Beløb': 'Amount', 'Saldo': 'Saldo'},
+        'dtypes': {'Dato': str, 'Tekst': str, 'Beløb': 'float64', 'Saldo': str},
+        'decimal': ',',
+        'thousands': '.',
+        'date_format': '%d.%m.%Y',
+        'currency': 'DKK',
+        'id_columns': ['Date', 'Description', 'Amount', 'Saldo'],
+    },
+    'Wise': {
+        'reader': 'csv',
+        'delimiter': ',',
+        'encoding': 'utf-8',
+        'columns': {
+            'ID': 'UniqueID', 'Status': 'Status', 'Direction': 'Direction', 'Finished on': 'Date',
+            'Source name': 'Source name', 'Source amount (after fees)': 'Source amount (after fees)', 'Source currency': 'Source currency',
+            'Target name': 'Target name', 'Target amount (after fees)': 'Target amount (after fees)', 'Target currency': 'Target currency',
+        },
+        'dtypes': {
+            'ID': str, 'Status': str, 'Direction': str, 'Finished on': str,
+            'Source name': str, 'Source amount (after fees)': 'float64', 'Source currency': str,
+            'Target name': str, 'Target amount (after fees)': 'float64', 'Target currency': str,
+        },
+        'date_format': '%Y-%m-%d %H:%M:%S',
+        'rows': _wise_rows,
+        'transform': _wise_transform,
+    },
+    'Lunar': {
+        'reader': 'csv',
+        'delimiter': ',',
+        'encoding': 'utf-8',
+        'columns': {'Dato': 'Date', 'Tekst': 'Description', 'Beløb': 'Amount', 'Saldo': 'Saldo', 'Valuta': 'Currency'},
+        'dtypes': {'Dato': str, 'Tekst': str, 'Beløb': 'float64', 'Saldo': str, 'Valuta': str},
+        'decimal': ',',
+        'thousands': '.',
+        'date_format': '%Y-%m-%d',
+        'id_columns': ['Date', 'Description', 'Amount', 'Saldo'],
+    },
+    'Skrill': {
+        'reader': 'csv',
+        'delimiter': ',',
+        'encoding': 'utf-8',
+        'columns': {'ID': 'UniqueID', 'Time (CET)': 'Date', 'Transaction Details': 'Description', 'Transaction Currency': 'Currency', '[-]': '[-]', '[+]': '[+]'},
+        'dtypes': {'ID': str, 'Time (CET)': str, 'Transaction Details': str, 'Transaction Currency': str, '[-]': str, '[+]': str},
+        'date_format': '%d %b %y %H:%M',
+        'transform': _skrill_transform,
+    },
+    'Norwegian': {
+        'reader': 'xlsx',
+        'columns': {
+            'TransactionDate': 'Date', 'Text': 'Description', 'Amount': 'Amount', 'Type': 'Type',
+            'Currency Amount': 'Amount_currency', 'Currency': 'Currency', 'Currency Rate': 'Currency_Rate',
+        },
+        'date_format': '%d.%m.%Y',
+        'id_columns': ['Date', 'Description', 'Amount'],
+        'rows': _norwegian_rows,
+    },
+    'Forbrugsforeningen': {
+        'reader': 'pdf',
+        'table_column': 'Dato',
+        'columns': {'Dato': 'Date', 'Posteringstekst': 'Description', 'Beløb': 'Amount', 'Valuta': 'Currency'},
+        'decimal': ',',
+        'thousands': '.',
+        'date_format': '%d/%m/%Y',
+        'id_columns': ['Date', 'Description', 'Amount'],
+    },
+}
+
+# Banks whose UniqueIDs are hashed by us; the others supply their own IDs, which say nothing
+# about the ID scheme
+HASHED_ID_BANKS = [bank for bank, bank_format in BANK_FORMATS.items() if 'id_columns' in bank_format]
+
+
+# UniqueIDs of the rows of df whose IDs we hashed (df needs Bank and UniqueID)
+def hashed_unique_ids(df):
+    return df.loc[df['Bank'].astype(str).isin(HASHED_ID_BANKS), 'UniqueID']
+
+
+def get_bank_format(bank, reader):
+    bank_format = BANK_FORMATS.get(bank)
+    if bank_format is None or bank_format['reader'] != reader:
+        raise ValueError("Unsupported bank")
+    return bank_format
+
+
+### READERS
+
+# Read only the declared columns of a CSV statement, straight into their final types.
+# With chunksize set, returns an iterator of DataFrames with at most that many rows.
+def read_csv_statement(file_path, bank_format, chunksize=None):
+    options = {
+        'delimiter': bank_format['delimiter'],
+        'encoding': bank_format['encoding'],
+        'usecols': list(bank_format['columns']),
+        'dtype': bank_format.get('dtypes'),
+    }
+
+    if 'decimal' in bank_format:
+        options['decimal'] = bank_format['decimal']
+    if 'thousands' in bank_format:
+        # The pyarrow engine has no thousands separator support; round_trip parses
+        # the amounts exactly like float() did in the old string replacements
+        options['thousands'] = bank_format['thousands']
+        options['float_precision'] = 'round_trip'
+    elif HAS_PYARROW and chunksize is None:
+        # pyarrow reads whole files only, chunked reads stay on the C engine
+        options['engine'] = 'pyarrow'
+
+    if chunksize is not None:
+        options['chunksize'] = chunksize
+
+    return pd.read_csv(file_path, **options)
+
+
+def read_xlsx_statement(file_path, bank_format):
+    options = {'usecols': list(bank_format['columns']), 'dtype': bank_format.get('dtypes')}
+    if HAS_CALAMINE:
+        options['engine'] = 'calamine'
+    return pd.read_excel(file_path, **options)
+
+
+# Convert text amounts such as '-1.234,56' to floats
+def parse_amounts(values, decimal=',', thousands='.'):
+    values = values.astype(str)
+    if thousands:
+        values = values.str.replace(thousands, '', regex=False)
+    return values.str.replace(decimal, '.', regex=False).astype(float)
+
+
+### NORMALIZATION
+
+# Turn a freshly read statement into the common STATEMENT_COLUMNS layout
+def normalize_statement(df, bank, bank_format, converter=None, id_scheme=None):
+    if 'rows' in bank_format:
+        df = bank_format['rows'](df)
+
+    df = df.rename(columns=bank_format['columns'])
+
+    # Parse the date column once; it stays datetime64 until a writer formats it
+    df['Date'] = pd.to_datetime(df['Date'], format=bank_format['date_format']).dt.normalize()
+
+    # Amounts that are still text (e.g. from PDF tables) use the declared number convention
+    if 'Amount' in df.columns and not pd.api.types.is_numeric_dtype(df['Amount']) and 'decimal' in bank_format:
+        df['Amount'] = parse_amounts(df['Amount'], bank_format['decimal'], bank_format.get('thousands'))
+
+    if 'transform' in bank_format:
+        df = bank_format['transform'](df, converter)
+
+    # Create unique identifier
+    if 'id_columns' in bank_format:
+        df['UniqueID'] = build_unique_ids(df, bank_format['id_columns'], id_scheme)
+
+    # Create bank identifier and defaults for single currency statements
+    df['Bank'] = bank
+    if 'currency' in bank_format:
+        df['Currency'] = bank_format['currency']
+    if 'Amount_currency' not in df.columns:
+        df['Amount_currency'] = df['Amount']
+    if 'Currency_Rate' not in df.columns:
+        df['Currency_Rate'] = 1
+
+    return df[STATEMENT_COLUMNS]
+
+
+### DETECTION
+
+# Guess the bank of a statement file from its header (CSV), first sheet row (XLSX) or the
+# tables on its first page (PDF). A bank matches when every column it reads is present; if
+# several match, the one that reads the most columns wins. Returns None when no format fits.
+def detect_bank(file_path):
+    extension = file_path.lower().rsplit('.', 1)[-1]
+    candidates = [(bank, bank_format) for bank, bank_format in BANK_FORMATS.items() if bank_format['reader'] == extension]
+
+    # A workbook or PDF that cannot be read (an Excel lock file, a corrupt download) matches no format
+    if extension == 'xlsx':
+        try:
+            headers = [{str(column) for column in pd.read_excel(file_path, nrows=0).columns}]
+        except Exception:
+            headers = []
+
+    if extension == 'pdf':
+        try:
+            headers = first_page_columns(file_path)
+        except Exception:
+            headers = []
+
+    matches = []
+    for bank, bank_format in candidates:
+        if extension == 'csv':
+            with open(file_path, 'r', encoding=bank_format['encoding'], errors='replace') as statement_file:
+                headers = [{column.strip().strip('"') for column in statement_file.readline().lstrip('\ufeff').rstrip('\r\n').split(bank_format['delimiter'])}]
+        if any(set(bank_format['columns']) <= table_headers for table_headers in headers):
+            matches.append((len(bank_format['columns']), bank))
+
+    return max(matches)[1] if matches else None
@@ -0,0 +1,158 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from category_cache import CategoryCache
+from excel_export import export_monthly_workbooks
+from ledger import LedgerStore
+from run_report import current_run, finish_run, merge, start_run, stage
+from main import (categorize_transactions, extract_statement, load_categorization_rules,
+                  process_and_export_data, update_existing_category)
+from transaction_batch import TransactionBatch
+from transfers import match_ledger_transfers
+
+STATEMENT_EXTENSIONS = ('.csv', '.pdf', '.xlsx')
+
+
+### BATCH DEFINITION
+
+# Read (file, bank) pairs from a JSON manifest: [{"file": "...", "bank": "Danske Bank"}, ...]
+# Relative file paths are taken relative to the manifest itself.
+def load_manifest(manifest_path):
+    with open(manifest_path, 'r') as json_file:
+        entries = json.load(json_file)
+
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    return [(os.path.join(base_dir, entry['file']), entry['bank']) for entry in entries]
+
+
+# Collect (file, bank) pairs from a directory with one sub-folder per bank, e.g.
+# statements/Danske Bank/2024-01.csv and statements/Wise/statement.csv
+def scan_directory(statements_dir):
+    entries = []
+    for bank in sorted(os.listdir(statements_dir)):
+        bank_dir = os.path.join(statements_dir, bank)
+        if not os.path.isdir(bank_dir):
+            continue
+        for file_name in sorted(os.listdir(bank_dir)):
+            if file_name.lower().endswith(STATEMENT_EXTENSIONS):
+                entries.append((os.path.join(bank_dir, file_name), bank))
+    return entries
+
+
+def load_batch(source):
+    return scan_directory(source) if os.path.isdir(source) else load_manifest(source)
+
+
+### IMPORT
+
+# Worker: extract one statement and report the outcome instead of swallowing errors.
+# With run_options (profile, trace_memory) the worker keeps its own run report and returns
+# its stages and counters, for the parent to merge into the batch's report.
+def _extract_entry(entry, id_scheme=None, run_options=None):
+    file_path, bank = entry
+    started = time.perf_counter()
+    if run_options is not None:
+        start_run(*run_options)
+    try:
+        transactions = extract_statement(file_path, bank, id_scheme, strict=True)
+        result = {'file': file_path, 'bank': bank, 'status': 'ok', 'rows': len(transactions),
+                  'seconds': round(time.perf_counter() - started, 3), 'transactions': transactions}
+    except Exception as e:
+        result = {'file': file_path, 'bank': bank, 'status': 'failed', 'rows': 0,
+                  'seconds': round(time.perf_counter() - started, 3), 'error': f"{type(e).__name__}: {str(e)}"}
+
+    report = finish_run() if run_options is not None else None
+    if report is not None:
+        result['run'] = {'started': report.started, 'stages': report.stages, 'counters': report.counters}
+    return result
+
+
+# Extract all statements in parallel, then categorize, deduplicate and export them in one pass.
+# Returns one report entry per file.
+def import_batch(entries, ledger_dir, categorization_rules_path, max_workers=None, excel_dir=None):
+    if not entries:
+        print("No statements to import.")
+        return []
+
+    # Workers build UniqueIDs with the scheme the ledger was created with
+    id_scheme = LedgerStore(ledger_dir).id_scheme()
+    run = current_run()
+    run_options = None if run is None else (run.profile, run.trace_memory)
+
+    with stage('extract_batch', files=len(entries)) as info:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(_extract_entry, entries, [id_scheme] * len(entries), [run_options] * len(entries)))
+        # The workers time their own files; their results become the per-file entries and
+        # their extract and conversion stages are nested under this one
+        for result in results:
+            worker_run = result.pop('run', None)
+            if worker_run is not None:
+                merge(worker_run['stages'], worker_run['counters'], worker_run['started'])
+        info['files_failed'] = sum(result['status'] != 'ok' for result in results)
+        info['rows_out'] = sum(result['rows'] for result in results)
+
+    transactions = TransactionBatch.concat([result.pop('transactions', TransactionBatch.empty()) for result in results])
+
+    categorization_rules_list = load_categorization_rules(categorization_rules_path)
+    category_cache = CategoryCache(ledger_dir)
+    categorized_transactions = categorize_transactions(transactions, categorization_rules_list, category_cache)
+
+    update_existing_category(ledger_dir, categorization_rules_path, category_cache)
+    try:
+        appended = process_and_export_data(categorized_transactions, ledger_dir, strict=True)
+    except Exception as e:
+        # Nothing reached the ledger, so every extracted file failed to import
+        for result in results:
+            if result['status'] == 'ok':
+                result.update(status='failed', error=f"Export failed: {type(e).__name__}: {str(e)}")
+        return results
+
+    match_ledger_transfers(ledger_dir, keys=list(appended))
+
+    if excel_dir:
+        export_monthly_workbooks(ledger_dir, excel_dir)
+
+    return results
+
+
+def print_report(report):
+    for result in report:
+        line = f"[{result['status']:>6}] {result['bank']:<20} {result['rows']:>7} rows  {result['seconds']:>7.3f}s  {result['file']}"
+        if result['status'] != 'ok':
+            line += f"\n         {result['error']}"
+        print(line)
+
+    failed = sum(result['status'] != 'ok' for result in report)
+    print(f"{len(report) - failed} of {len(report)} statements imported, {failed} failed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import many bank statements in one run")
+    parser.add_argument('source', help="directory with one sub-folder per bank, or a JSON manifest of {file, bank} entries")
+    parser.add_argument('--ledger', required=True, help="ledger directory")
+    parser.add_argument('--rules', default='categorization_rules.json', help="categorization rules JSON file")
+    parser.add_argument('--excel', help="also rebuild the monthly Excel workbooks of changed months in this directory")
+    parser.add_argument('--workers', type=int, default=None, help="number of worker processes")
+    parser.add_argument('--report', help="also write the per-file report to this JSON file")
+    parser.add_argument('--run-report', help="write per-stage timings and row counts to this JSON file")
+    parser.add_argument('--profile', action='store_true', help="add cProfile hot spots to the run report")
+    parser.add_argument('--trace-memory', action='store_true', help="add peak memory per stage to the run report")
+    args = parser.parse_args()
+
+    start_run(profile=args.profile, trace_memory=args.trace_memory)
+    report = import_batch(load_batch(args.source), args.ledger, args.rules, args.workers, args.excel)
+    finish_run(args.run_report)
+    print_report(report)
+
+    if args.report:
+        with open(args.report, 'w') as json_file:
+            json.dump(report, json_file, indent=4)
+
+    return 0 if all(result['status'] == 'ok' for result in report) else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,173 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+# Never touch the network: rates come from a synthetic ECB history written below
+os.environ['AUTOBANKING_OFFLINE'] = '1'
+
+import pandas as pd
+
+import main
+from benchmarks.synthetic import (LEDGER_ID_SCHEME, STATEMENT_WRITERS, generate_ledger, generate_rules, generate_statement,
+                                  write_rate_history)
+from currency import RateStore
+
+# Run from the repository root:
+#   python -m benchmarks.run_benchmarks --statement-rows 1000 10000 --rule-counts 10 1000 --ledger-rows 10000
+# Generated inputs are kept in the work directory and reused by later runs with the same sizes.
+
+DEFAULT_STATEMENT_ROWS = [1000, 10000, 100000]
+DEFAULT_RULE_COUNTS = [10, 100, 1000, 10000]
+DEFAULT_LEDGER_ROWS = [10000, 100000, 1000000]
+
+
+### MEASUREMENT
+
+# Run fn once and return (result, seconds, peak MiB). The pipeline's own prints are
+# swallowed so they do not end up in the timings or the output.
+def measure(fn, *args, trace_memory=True, **kwargs):
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = fn(*args, **kwargs)
+    finally:
+        seconds = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1] / 2 ** 20 if trace_memory else None
+        if trace_memory:
+            tracemalloc.stop()
+    return result, seconds, peak
+
+
+def record(results, stage, seconds, peak_mb, **params):
+    entry = {'stage': stage, **params, 'seconds': round(seconds, 4), 'peak_mb': None if peak_mb is None else round(peak_mb, 2)}
+    results.append(entry)
+    details = ' '.join(f'{key}={value}' for key, value in params.items())
+    peak = '' if peak_mb is None else f'{peak_mb:>10.1f} MiB'
+    print(f"{stage:<26} {details:<48} {seconds:>9.3f}s {peak}")
+
+
+### STAGES
+
+def bench_extraction(results, work_dir, banks, statement_rows, trace_memory):
+    for bank in banks:
+        for rows in statement_rows:
+            path = generate_statement(os.path.join(work_dir, 'statements'), bank, rows)
+            transactions, seconds, peak = measure(main.extract_statement, path, bank, strict=True, trace_memory=trace_memory)
+            record(results, 'extract', seconds, peak, bank=bank, rows=rows, rows_out=len(transactions))
+
+
+def bench_categorization(results, work_dir, rule_counts, statement_rows, trace_memory):
+    rows = max(statement_rows)
+    path = generate_statement(os.path.join(work_dir, 'statements'), 'Danske Bank', rows)
+    with contextlib.redirect_stdout(io.StringIO()):
+        transactions = main.extract_statement(path, 'Danske Bank', strict=True)
+
+    for count in rule_counts:
+        rules = main.load_categorization_rules(generate_rules(os.path.join(work_dir, f'rules_{count}.json'), count))
+        categorized, seconds, peak = measure(main.categorize_transactions, transactions, rules, trace_memory=trace_memory)
+        uncategorized = int((categorized['Main Category'] == 'Uncategorized').sum())
+        record(results, 'categorize', seconds, peak, rows=rows, rules=count, uncategorized=uncategorized)
+
+
+# A fresh copy of a generated ledger, so every stage starts from the same state
+def _ledger_copy(work_dir, rows):
+    source = os.path.join(work_dir, 'ledgers', str(rows))
+    if not os.path.isdir(source):
+        with contextlib.redirect_stdout(io.StringIO()):
+            generate_ledger(source + '.tmp', rows)
+        os.replace(source + '.tmp', source)
+
+    target = os.path.join(work_dir, 'run', str(rows))
+    shutil.rmtree(target, ignore_errors=True)
+    shutil.copytree(source, target)
+    return target
+
+
+def bench_ledger(results, work_dir, ledger_rows, rule_counts, statement_rows, trace_memory):
+    new_rows = min(statement_rows)
+    statement = generate_statement(os.path.join(work_dir, 'statements'), 'Danske Bank', new_rows, seed=1)
+    with contextlib.redirect_stdout(io.StringIO()):
+        new_transactions = main.extract_statement(statement, 'Danske Bank', LEDGER_ID_SCHEME, strict=True)
+
+    for rows in ledger_rows:
+        # Full re-categorization pass (no rule state yet) for every rule file size
+        for count in rule_counts:
+            ledger_dir = _ledger_copy(work_dir, rows)
+            rules_path = generate_rules(os.path.join(work_dir, f'rules_{count}.json'), count)
+            _, seconds, peak = measure(main.update_existing_category, ledger_dir, rules_path, trace_memory=trace_memory)
+            record(results, 'update_existing_category', seconds, peak, ledger_rows=rows, rules=count)
+
+        # Dedup and append a statement; the first call also builds the UniqueID index
+        ledger_dir = _ledger_copy(work_dir, rows)
+        categorized = main.categorize_transactions(new_transactions, [])
+        _, seconds, peak = measure(main.process_and_export_data, categorized, ledger_dir, compact=False, trace_memory=trace_memory)
+        record(results, 'export (cold index)', seconds, peak, ledger_rows=rows, rows=new_rows)
+
+        # Importing the same statement again: everything is a duplicate
+        _, seconds, peak = measure(main.process_and_export_data, categorized, ledger_dir, compact=False, trace_memory=trace_memory)
+        record(results, 'export (warm index)', seconds, peak, ledger_rows=rows, rows=new_rows)
+
+        shutil.rmtree(os.path.join(work_dir, 'run'), ignore_errors=True)
+
+
+### RUNNER
+
+def main_benchmarks():
+    parser = argparse.ArgumentParser(description="Time the import pipeline on synthetic statements, rules and ledgers")
+    parser.add_argument('--work-dir', help="where generated inputs are kept (default: a temporary directory)")
+    parser.add_argument('--banks', nargs='+', default=list(STATEMENT_WRITERS), choices=list(STATEMENT_WRITERS))
+    parser.add_argument('--statement-rows', nargs='+', type=int, default=DEFAULT_STATEMENT_ROWS)
+    parser.add_argument('--rule-counts', nargs='+', type=int, default=DEFAULT_RULE_COUNTS)
+    parser.add_argument('--ledger-rows', nargs='+', type=int, default=DEFAULT_LEDGER_ROWS, help="e.g. 10000 ... 10000000")
+    parser.add_argument('--stages', nargs='+', default=['extract', 'categorize', 'ledger'], choices=['extract', 'categorize', 'ledger'])
+    parser.add_argument('--no-memory', action='store_true', help="skip tracemalloc, which slows the stages down")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='autobanking-bench-')
+    os.makedirs(work_dir, exist_ok=True)
+    trace_memory = not args.no_memory
+
+    # Convert currencies from a synthetic rate history instead of the ECB
+    rates_zip = write_rate_history(os.path.join(work_dir, 'eurofxref-hist.zip'))
+    rates_db = os.path.join(work_dir, 'exchange_rates.sqlite')
+    if os.path.isfile(rates_db):
+        os.remove(rates_db)
+    main.c = RateStore(db_path=rates_db, offline=True, seed_file=rates_zip)
+
+    results = []
+    if 'extract' in args.stages:
+        bench_extraction(results, work_dir, args.banks, args.statement_rows, trace_memory)
+    if 'categorize' in args.stages:
+        bench_categorization(results, work_dir, args.rule_counts, args.statement_rows, trace_memory)
+    if 'ledger' in args.stages:
+        bench_ledger(results, work_dir, args.ledger_rows, args.rule_counts, args.statement_rows, trace_memory)
+
+    if args.output:
+        report = {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+            'memory_traced': trace_memory,
+            'results': results,
+        }
+        with open(args.output, 'w') as json_file:
+            json.dump(report, json_file, indent=4)
+        print(f"Results written to {args.output}")
+
+    if not args.work_dir:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main_benchmarks()
@@ -0,0 +1,277 @@
+import csv
+import json
+import os
+from io import StringIO
+from zipfile import ZIP_DEFLATED, ZipFile
+
+import numpy as np
+import pandas as pd
+
+from ledger import LedgerStore
+from unique_ids import build_unique_ids
+
+# Everything here is generated from a seeded NumPy generator, so the same arguments always
+# give byte-identical files and benchmark runs on different versions see the same inputs.
+
+START_DATE = '2023-01-01'
+DAYS = 730
+
+CURRENCIES = ['EUR', 'USD', 'GBP', 'SEK', 'NOK']
+
+# EUR reference rates the synthetic ECB history drifts around
+BASE_RATES = {'DKK': 7.45, 'USD': 1.08, 'GBP': 0.86, 'SEK': 11.3, 'NOK': 11.5}
+
+MAIN_CATEGORIES = {
+    'Food': ['Groceries', 'Restaurants', 'Takeaway'],
+    'Transport': ['Fuel', 'Public transport', 'Parking'],
+    'Home': ['Rent', 'Utilities', 'Furniture'],
+    'Leisure': ['Subscriptions', 'Travel', 'Sports'],
+    'Income': ['Salary', 'Refunds', 'Interest'],
+}
+
+_SYLLABLES = ['net', 'to', 'fø', 'tex', 'bil', 'ka', 'spot', 'ify', 'lid', 'rema', 'co', 'op', 'su', 'per',
+              'brug', 'sen', 'ir', 'ma', 'shell', 'q8', 'dsb', 'rej', 'ser', 'mo', 'bi', 'ly', 'ik', 'ea']
+_SUFFIXES = ['', '', '', ' ApS', ' A/S', ' København', ' Aarhus', ' Online', ' 24', ' Nord']
+
+_MONTH_ABBREVIATIONS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+
+### BUILDING BLOCKS
+
+# Distinct merchant names built from syllables, e.g. 'Netkabil A/S'
+def merchant_names(count, seed=0):
+    rng = np.random.default_rng(seed)
+    names = []
+    seen = set()
+    while len(names) < count:
+        name = ''.join(rng.choice(_SYLLABLES, size=rng.integers(2, 5))).capitalize()
+        name += _SUFFIXES[rng.integers(len(_SUFFIXES))]
+        if name not in seen:
+            seen.add(name)
+            names.append(name)
+    return names
+
+
+# Descriptions with a Zipf-like repeat pattern: a few merchants show up very often,
+# most only now and then, like a real statement. Some carry a card or reference suffix.
+def descriptions(rng, rows, merchants):
+    weights = 1.0 / np.arange(1, len(merchants) + 1)
+    picks = rng.choice(len(merchants), size=rows, p=weights / weights.sum())
+    suffixes = rng.integers(1000, 9999, size=rows)
+    with_suffix = rng.random(rows) < 0.3
+    return [f'{merchants[pick]} {suffix}' if flag else merchants[pick]
+            for pick, suffix, flag in zip(picks.tolist(), suffixes.tolist(), with_suffix.tolist())]
+
+
+def dates(rng, rows, start=START_DATE, days=DAYS):
+    offsets = np.sort(rng.integers(0, days, size=rows))
+    return pd.Timestamp(start) + pd.to_timedelta(offsets, unit='D')
+
+
+# Mostly small card payments, a few large incoming transfers
+def amounts(rng, rows):
+    values = -np.round(rng.lognormal(mean=4.5, sigma=1.1, size=rows), 2)
+    incoming = rng.random(rows) < 0.05
+    values[incoming] = np.round(rng.uniform(1000, 40000, size=int(incoming.sum())), 2)
+    return values
+
+
+# 1234.5 -> '1.234,50' (Danish number format)
+def danish_numbers(values):
+    return [f'{value:,.2f}'.translate(str.maketrans(',.', '.,')) for value in values]
+
+
+### STATEMENTS
+
+def write_danske_bank(path, rows, seed=0):
+    rng = np.random.default_rng(seed)
+    amount = amounts(rng, rows)
+    df = pd.DataFrame({
+        'Dato': dates(rng, rows).strftime('%d.%m.%Y'),
+        'Tekst': descriptions(rng, rows, merchant_names(500, seed)),
+        'Beløb': danish_numbers(amount),
+        'Saldo': danish_numbers(10000 + np.cumsum(amount)),
+        'Status': 'Udført',
+        'Afstemt': 'Nej',
+    })
+    df.to_csv(path, sep=';', index=False, encoding='ISO-8859-1', errors='replace')
+
+
+def write_lunar(path, rows, seed=0):
+    rng = np.random.default_rng(seed)
+    amount = amounts(rng, rows)
+    df = pd.DataFrame({
+        'Dato': dates(rng, rows).strftime('%Y-%m-%d'),
+        'Tekst': descriptions(rng, rows, merchant_names(500, seed)),
+        'Beløb': danish_numbers(amount),
+        'Saldo': danish_numbers(10000 + np.cumsum(amount)),
+        'Valuta': 'DKK',
+        'Kategori': rng.choice(list(MAIN_CATEGORIES), size=rows),
+    })
+    df.to_csv(path, index=False, encoding='utf-8')
+
+
+def write_wise(path, rows, seed=0):
+    rng = np.random.default_rng(seed)
+    merchants = merchant_names(500, seed)
+    finished = dates(rng, rows) + pd.to_timedelta(rng.integers(0, 86400, size=rows), unit='s')
+    direction = rng.choice(['OUT', 'IN', 'NEUTRAL'], size=rows, p=[0.8, 0.15, 0.05])
+    source_currency = rng.choice(CURRENCIES, size=rows)
+    target_currency = np.where(direction == 'NEUTRAL', rng.choice(CURRENCIES, size=rows), source_currency)
+    amount = np.round(rng.lognormal(mean=3.5, sigma=1.0, size=rows), 2)
+    df = pd.DataFrame({
+        'ID': [f'TRANSFER-{seed}-{row}' for row in range(rows)],
+        'Status': rng.choice(['COMPLETED', 'CANCELLED'], size=rows, p=[0.97, 0.03]),
+        'Direction': direction,
+        'Created on': finished.strftime('%Y-%m-%d %H:%M:%S'),
+        'Finished on': finished.strftime('%Y-%m-%d %H:%M:%S'),
+        'Source fee amount': 0,
+        'Source fee currency': source_currency,
+        'Target fee amount': '',
+        'Target fee currency': '',
+        'Source name': np.where(direction == 'IN', descriptions(rng, rows, merchants), 'Me'),
+        'Source amount (after fees)': amount,
+        'Source currency': source_currency,
+        'Target name': np.where(direction == 'OUT', descriptions(rng, rows, merchants), 'Me'),
+        'Target amount (after fees)': amount,
+        'Target currency': target_currency,
+        'Exchange rate': 1,
+        'Reference': '',
+        'Batch': '',
+    })
+    df.to_csv(path, index=False, encoding='utf-8')
+
+
+def write_skrill(path, rows, seed=0):
+    rng = np.random.default_rng(seed)
+    timestamps = dates(rng, rows) + pd.to_timedelta(rng.integers(0, 1440, size=rows), unit='min')
+    amount = amounts(rng, rows) / 10
+    times = [f'{stamp.day:02d} {_MONTH_ABBREVIATIONS[stamp.month - 1]} {stamp.year % 100:02d} {stamp.hour:02d}:{stamp.minute:02d}'
+             for stamp in timestamps]
+    df = pd.DataFrame({
+        'ID': np.arange(1000000, 1000000 + rows),
+        'Time (CET)': times,
+        'Type': 'Send Money',
+        'Transaction Details': descriptions(rng, rows, merchant_names(200, seed)),
+        '[-]': [f'{-value:.2f}' if value < 0 else '' for value in amount],
+        '[+]': [f'{value:.2f}' if value > 0 else '' for value in amount],
+        'Status': 'processed',
+        'balance': np.round(100 + np.cumsum(amount), 2),
+        'Reference': '',
+        'Amount Fee': '',
+        'Transaction Currency': rng.choice(['EUR', 'USD'], size=rows),
+    })
+    df.to_csv(path, index=False, encoding='utf-8', quoting=csv.QUOTE_MINIMAL)
+
+
+def write_norwegian(path, rows, seed=0):
+    rng = np.random.default_rng(seed)
+    currency = rng.choice(['DKK', 'DKK', 'DKK', 'EUR', 'NOK'], size=rows)
+    eur_rates = dict(BASE_RATES, EUR=1.0)
+    rate = np.array([eur_rates['DKK'] / eur_rates[value] for value in currency])
+    currency_amount = amounts(rng, rows)
+    df = pd.DataFrame({
+        'TransactionDate': dates(rng, rows).strftime('%d.%m.%Y'),
+        'Text': descriptions(rng, rows, merchant_names(300, seed)),
+        'Amount': np.round(currency_amount * rate, 2),
+        'Type': rng.choice(['Køb', 'Reserveret', 'Indbetaling'], size=rows, p=[0.9, 0.05, 0.05]),
+        'Currency Amount': currency_amount,
+        'Currency': currency,
+        'Currency Rate': np.round(rate, 4),
+    })
+    df.to_excel(path, index=False)
+
+
+# bank -> (file extension, writer(path, rows, seed))
+STATEMENT_WRITERS = {
+    'Danske Bank': ('.csv', write_danske_bank),
+    'Wise': ('.csv', write_wise),
+    'Lunar': ('.csv', write_lunar),
+    'Skrill': ('.csv', write_skrill),
+    'Norwegian': ('.xlsx', write_norwegian),
+}
+
+
+# Write a statement for a bank unless an identical one (same rows and seed) already exists
+def generate_statement(out_dir, bank, rows, seed=0):
+    extension, writer = STATEMENT_WRITERS[bank]
+    path = os.path.join(out_dir, f'{bank.replace(" ", "_")}_{rows}_{seed}{extension}')
+    if not os.path.isfile(path):
+        os.makedirs(out_dir, exist_ok=True)
+        writer(path + '.tmp' + extension, rows, seed)
+        os.replace(path + '.tmp' + extension, path)
+    return path
+
+
+### RULES
+
+# A rules file with the given number of keywords. Keywords are prefixes of the merchant
+# names used by the statements, so a realistic share of the rows is categorized.
+def generate_rules(path, keywords, seed=0):
+    rng = np.random.default_rng(seed)
+    pairs = [(main, sub) for main, subs in MAIN_CATEGORIES.items() for sub in subs]
+    merchants = merchant_names(500, 0) + merchant_names(max(keywords - 500, 0), seed + 1)
+    rules = []
+    for name in merchants[:keywords]:
+        main, sub = pairs[rng.integers(len(pairs))]
+        rules.append({'Keyword': name[:max(4, int(len(name) * 0.8))], 'Main Category': main, 'Sub Category': sub})
+
+    with open(path, 'w', encoding='utf-8') as json_file:
+        json.dump(rules, json_file, indent=4, ensure_ascii=False)
+    return path
+
+
+### LEDGERS
+
+# Generated ledgers use the fast ID scheme; statements imported into them must match it
+LEDGER_ID_SCHEME = 'hash64'
+
+# Fill a ledger directory with the given number of already categorized rows.
+# Rows are generated and appended in chunks, so a 10M row ledger never sits in memory.
+def generate_ledger(ledger_dir, rows, seed=0, chunk_rows=1000000):
+    rng = np.random.default_rng(seed)
+    store = LedgerStore(ledger_dir)
+    store.id_scheme(LEDGER_ID_SCHEME)
+    merchants = merchant_names(500, seed)
+    pairs = [(main, sub) for main, subs in MAIN_CATEGORIES.items() for sub in subs]
+
+    for start in range(0, rows, chunk_rows):
+        count = min(chunk_rows, rows - start)
+        amount = amounts(rng, count)
+        pair = rng.integers(len(pairs), size=count)
+        df = pd.DataFrame({
+            'Date': dates(rng, count),
+            'Description': descriptions(rng, count, merchants),
+            'Amount': amount,
+            'Amount_currency': amount,
+            'Currency': 'DKK',
+            'Currency_Rate': 1.0,
+            'Bank': rng.choice(list(STATEMENT_WRITERS), size=count),
+            'Serial': np.arange(start, start + count),
+            'Main Category': [pairs[index][0] for index in pair.tolist()],
+            'Sub Category': [pairs[index][1] for index in pair.tolist()],
+            'Rule': '',
+        })
+        df['UniqueID'] = build_unique_ids(df, ['Serial'], scheme=LEDGER_ID_SCHEME)
+        store.append(df.drop(columns='Serial'))
+
+    store.compact()
+    return ledger_dir
+
+
+### EXCHANGE RATES
+
+# A zipped ECB-style history (EUR based, business days) for offline currency conversion
+def write_rate_history(path, seed=0, start=START_DATE, days=DAYS + 30):
+    rng = np.random.default_rng(seed)
+    business_days = pd.bdate_range(start, periods=days)
+    table = pd.DataFrame({'Date': business_days.strftime('%Y-%m-%d')})
+    for currency, base in BASE_RATES.items():
+        drift = np.cumsum(rng.normal(0, 0.002, size=len(business_days)))
+        table[currency] = np.round(base * np.exp(drift), 4)
+
+    buffer = StringIO()
+    table.iloc[::-1].to_csv(buffer, index=False)
+    with ZipFile(path, 'w', ZIP_DEFLATED) as zip_file:
+        zip_file.writestr('eurofxref-hist.csv', buffer.getvalue())
+    return path
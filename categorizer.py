@@ -0,0 +1,179 @@
+import hashlib
+import json
+
+import numpy as np
+import pandas as pd
+
+UNCATEGORIZED = 'Uncategorized'
+
+# Key used inside a trie node to store the index of the rule whose keyword ends there.
+# Descriptions are matched one character at a time, so the empty string never clashes.
+_TERMINAL = ''
+
+
+class RuleTrie:
+    # Compiled form of a categorization rule list.
+    # Every keyword is lower-cased once and inserted into a prefix trie, so matching a
+    # description costs a walk of at most len(description) nodes instead of a loop
+    # over every rule. When several keywords match, the rule listed first in the file
+    # wins, exactly like the original nested loops.
+    def __init__(self, rules, keyword_field='Keyword', value_fields=('Main Category', 'Sub Category')):
+        self.rules = list(rules)
+        self.value_fields = tuple(value_fields)
+        self.keywords = [None if rule.get(keyword_field) is None else str(rule.get(keyword_field)).lower() for rule in self.rules]
+        self.root = {}
+
+        for index, keyword in enumerate(self.keywords):
+            if keyword is None:
+                continue
+
+            node = self.root
+            for char in keyword:
+                node = node.setdefault(char, {})
+
+            # Keep the earliest rule if the same keyword is listed more than once
+            node.setdefault(_TERMINAL, index)
+
+        # A prefix match never looks further into a description than the longest keyword
+        self.max_keyword_length = max((len(keyword) for keyword in self.keywords if keyword is not None), default=0)
+        self._fingerprint = None
+
+    @property
+    def fingerprint(self):
+        if self._fingerprint is None:
+            self._fingerprint = rules_fingerprint(self.rules)
+        return self._fingerprint
+
+    # Normalized form of a description for the category cache: lower-cased and cut to the
+    # longest keyword. Descriptions with the same key always match the same rule in prefix
+    # mode, so 'Netto 1234' and 'Netto 5678' share one entry when keywords are short.
+    # categorize() builds the same keys for a whole Series at once.
+    def cache_key(self, description):
+        return description.lower()[:self.max_keyword_length]
+
+    # Return the index of the first rule whose keyword the text starts with, or None
+    def match_prefix(self, text):
+        node = self.root
+        best = node.get(_TERMINAL)
+
+        for char in text:
+            node = node.get(char)
+            if node is None:
+                break
+            index = node.get(_TERMINAL)
+            if index is not None and (best is None or index < best):
+                best = index
+
+        return best
+
+    # Return the index of the first rule whose keyword appears anywhere in the text, or None
+    def match_substring(self, text):
+        best = self.root.get(_TERMINAL)
+
+        for start in range(len(text)):
+            node = self.root
+            for char in text[start:]:
+                node = node.get(char)
+                if node is None:
+                    break
+                index = node.get(_TERMINAL)
+                if index is not None and (best is None or index < best):
+                    best = index
+
+        return best
+
+    # Find the matching rule for a single description ('prefix' or 'substring' mode)
+    def lookup(self, description, mode='prefix'):
+        index = self._match_index(description, mode)
+        return None if index is None else self.rules[index]
+
+    def _match_index(self, description, mode):
+        if not isinstance(description, str):
+            return None
+        match = self.match_prefix if mode == 'prefix' else self.match_substring
+        return match(description.lower())
+
+    # Categorize a whole pandas Series of descriptions in one call.
+    # Each distinct description is matched only once, and the result is a DataFrame
+    # with one column per value field, aligned with the input index. With rule_column
+    # set, an extra column records the lower-cased keyword that matched ('' for none).
+    # A CategoryCache remembers prefix matches across calls and runs.
+    def categorize(self, descriptions, mode='prefix', default=UNCATEGORIZED, rule_column=None, cache=None):
+        if mode not in ('prefix', 'substring'):
+            raise ValueError(f"Unsupported match mode: {mode}")
+
+        descriptions = pd.Series(descriptions)
+        codes, uniques = pd.factorize(descriptions)
+
+        if cache is not None and mode == 'prefix':
+            # Many descriptions share a key, so each distinct key is resolved only once
+            is_text = np.array([isinstance(description, str) for description in uniques], dtype=bool)
+            keys = pd.Series(uniques[is_text], dtype=object).str.lower().str[:self.max_keyword_length]
+            key_codes, distinct_keys = pd.factorize(keys)
+            resolved = np.array(cache.resolve(self.fingerprint, distinct_keys, self.match_prefix) + [None], dtype=object)
+            indexes = np.full(len(uniques), None, dtype=object)
+            indexes[is_text] = resolved[key_codes]
+            indexes = indexes.tolist()
+        else:
+            indexes = [self._match_index(description, mode) for description in uniques]
+        matched = [None if index is None else self.rules[index] for index in indexes]
+
+        columns = {}
+        for field in self.value_fields:
+            # The extra trailing default is picked up by code -1 (missing descriptions)
+            values = np.array([default if rule is None else rule.get(field, default) for rule in matched] + [default], dtype=object)
+            columns[field] = values[codes]
+
+        if rule_column is not None:
+            keywords = np.array(['' if index is None else self.keywords[index] for index in indexes] + [''], dtype=object)
+            columns[rule_column] = keywords[codes]
+
+        return pd.DataFrame(columns, index=descriptions.index)
+
+    # Boolean Series telling which descriptions match any rule
+    def matches(self, descriptions, mode='prefix'):
+        descriptions = pd.Series(descriptions)
+        codes, uniques = pd.factorize(descriptions)
+        found = np.array([self._match_index(description, mode) is not None for description in uniques] + [False])
+        return pd.Series(found[codes], index=descriptions.index)
+
+
+### RULE SET CHANGES
+
+# Stable fingerprint of a rule list; any edit, addition, removal or reordering changes it
+def rules_fingerprint(rules):
+    canonical = json.dumps(rules, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+# The rules that can actually match, as [keyword, main category, sub category] in file order.
+# Keywords are lower-cased and only the first rule per keyword is kept, as in RuleTrie.
+def effective_rules(rules):
+    seen = set()
+    effective = []
+    for rule in rules:
+        keyword = rule.get('Keyword')
+        if keyword is None or str(keyword).lower() in seen:
+            continue
+        keyword = str(keyword).lower()
+        seen.add(keyword)
+        effective.append([keyword, rule.get('Main Category'), rule.get('Sub Category')])
+    return effective
+
+
+# Compare two effective rule lists.
+# Returns added/removed keywords, keywords whose categories were edited, and whether the
+# keywords present in both lists changed their relative order.
+def diff_rules(old_rules, new_rules):
+    old = {keyword: (main_category, sub_category) for keyword, main_category, sub_category in old_rules}
+    new = {keyword: (main_category, sub_category) for keyword, main_category, sub_category in new_rules}
+
+    common_old_order = [rule[0] for rule in old_rules if rule[0] in new]
+    common_new_order = [rule[0] for rule in new_rules if rule[0] in old]
+
+    return {
+        'added': [keyword for keyword in new if keyword not in old],
+        'removed': [keyword for keyword in old if keyword not in new],
+        'edited': [keyword for keyword in new if keyword in old and old[keyword] != new[keyword]],
+        'reordered': common_old_order != common_new_order,
+    }
@@ -0,0 +1,136 @@
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+CACHE_FILE = '_category_cache.sqlite'
+
+# Entries kept, in memory and on disk; the least recently used ones are dropped beyond this
+MAX_ENTRIES = 200000
+
+# Stored for descriptions no rule matches
+NO_RULE = -1
+
+
+class CategoryCache:
+    # Persistent memo of normalized description -> index of the rule that categorizes it,
+    # kept in SQLite next to the ledger partitions. Merchant texts repeat all the time, so
+    # after the first run almost every description is answered by one dict lookup instead
+    # of a trie walk. Rule indexes are only valid for the rule list they were computed
+    # with: the cache stores that list's fingerprint and empties itself when it changes.
+    # The most recently used max_entries are read into memory on first use and kept in LRU
+    # order, so a long-running service never holds more; new entries are written by save().
+    def __init__(self, ledger_dir, max_entries=MAX_ENTRIES):
+        os.makedirs(ledger_dir, exist_ok=True)
+        self.cache_path = os.path.join(ledger_dir, CACHE_FILE)
+        self.max_entries = max_entries
+        self.fingerprint = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = None
+        self._new = {}
+        self._used = set()
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.cache_path)
+        connection.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, rule INTEGER, used INTEGER) WITHOUT ROWID')
+        connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        return connection
+
+    # Load the entries computed with the given rules, or start over if the rules changed
+    def _load(self, fingerprint):
+        if self._entries is not None and self.fingerprint == fingerprint:
+            return
+
+        connection = self._connect()
+        try:
+            row = connection.execute("SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+            if row is not None and row[0] == fingerprint:
+                # Least recently used first, the order the LRU evicts in
+                self._entries = OrderedDict(connection.execute('SELECT key, rule FROM (SELECT key, rule, used FROM entries ORDER BY used DESC LIMIT ?) ORDER BY used',
+                                                               (self.max_entries,)))
+            else:
+                connection.execute('DELETE FROM entries')
+                connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('fingerprint', ?)", (fingerprint,))
+                connection.commit()
+                self._entries = OrderedDict()
+        finally:
+            connection.close()
+
+        self.fingerprint = fingerprint
+        self._new = {}
+        self._used = set()
+
+    # Rule index (or None) for each key, calling compute(key) only for keys not cached yet
+    def resolve(self, fingerprint, keys, compute):
+        with self._lock:
+            self._load(fingerprint)
+            entries = self._entries
+            indexes = [entries.get(key) for key in keys]
+
+            misses = 0
+            for position, index in enumerate(indexes):
+                if index is None:
+                    key = keys[position]
+                    index = compute(key)
+                    index = NO_RULE if index is None else index
+                    entries[key] = self._new[key] = index
+                    indexes[position] = index
+                    misses += 1
+                    if len(entries) > self.max_entries:
+                        self._evict()
+                elif keys[position] in entries:
+                    entries.move_to_end(keys[position])
+                    self._used.add(keys[position])
+
+            self.hits += len(indexes) - misses
+            self.misses += misses
+            return [None if index == NO_RULE else index for index in indexes]
+
+    # Drop the least recently used entry from memory; a new one that was never saved is lost,
+    # which only costs a trie walk the next time its description comes up
+    def _evict(self):
+        key, _ = self._entries.popitem(last=False)
+        self._new.pop(key, None)
+        self._used.discard(key)
+
+    # Write new entries, mark the used ones as recent and drop the least recently used
+    def save(self):
+        with self._lock:
+            if self._entries is None or (not self._new and not self._used):
+                return
+
+            connection = self._connect()
+            try:
+                row = connection.execute("SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+                if row is None or row[0] != self.fingerprint:
+                    # Another run changed the rules in the meantime; these entries are stale there
+                    return
+
+                row = connection.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+                generation = 1 if row is None else int(row[0]) + 1
+                connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('generation', ?)", (str(generation),))
+
+                connection.executemany('INSERT OR REPLACE INTO entries (key, rule, used) VALUES (?, ?, ?)',
+                                       ((key, index, generation) for key, index in self._new.items()))
+                connection.executemany('UPDATE entries SET used = ? WHERE key = ?', ((generation, key) for key in self._used))
+
+                excess = connection.execute('SELECT COUNT(*) FROM entries').fetchone()[0] - self.max_entries
+                if excess > 0:
+                    connection.execute('DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY used LIMIT ?)', (excess,))
+                connection.commit()
+            finally:
+                connection.close()
+
+            self._new = {}
+            self._used = set()
+
+    def stats(self):
+        looked_up = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / looked_up, 4) if looked_up else None,
+            'entries': 0 if self._entries is None else len(self._entries),
+        }
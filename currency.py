@@ -0,0 +1,265 @@
+import os
+import sqlite3
+import threading
+import xml.etree.ElementTree as ET
+from bisect import bisect_left
+from datetime import date, datetime
+from io import BytesIO
+from urllib.request import urlopen
+from zipfile import ZipFile
+
+import numpy as np
+import pandas as pd
+
+from run_report import stage
+
+try:
+    # The currency_converter package ships a copy of the ECB history we can seed from offline
+    from currency_converter import CURRENCY_FILE as BUNDLED_RATES_FILE
+except ImportError:
+    BUNDLED_RATES_FILE = None
+
+TARGET_CURRENCY = 'DKK'
+REF_CURRENCY = 'EUR'
+
+ECB_HISTORY_URL = 'https://www.ecb.europa.eu/stats/eurofxref/eurofxref-hist.zip'
+ECB_RECENT_URL = 'https://www.ecb.europa.eu/stats/eurofxref/eurofxref-hist-90d.xml'
+
+# The 90 day feed is enough to fill gaps shorter than this, otherwise fetch the full history
+RECENT_FEED_DAYS = 85
+
+RATES_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'exchange_rates.sqlite')
+
+
+### ECB FEED PARSING
+
+# Yield (currency, date, rate) from the lines of the ECB history CSV
+def parse_ecb_csv_lines(lines):
+    lines = iter(lines)
+    header = [currency.strip() for currency in next(lines).strip().split(',')[1:]]
+
+    for line in lines:
+        fields = line.strip().split(',')
+        if not fields[0]:
+            continue
+        this_date = datetime.strptime(fields[0], '%Y-%m-%d').date()
+        for currency, rate in zip(header, fields[1:]):
+            if currency and rate not in ('', 'N/A'):
+                yield currency, this_date, float(rate)
+
+
+def parse_ecb_zip(content):
+    zip_file = ZipFile(BytesIO(content))
+    for name in zip_file.namelist():
+        yield from parse_ecb_csv_lines(zip_file.read(name).decode('utf-8').splitlines())
+
+
+# Yield (currency, date, rate) from the ECB 90 day XML feed
+def parse_ecb_xml(content):
+    this_date = None
+    for element in ET.fromstring(content).iter():
+        if 'time' in element.attrib:
+            this_date = datetime.strptime(element.attrib['time'], '%Y-%m-%d').date()
+        elif 'currency' in element.attrib and this_date is not None:
+            yield element.attrib['currency'], this_date, float(element.attrib['rate'])
+
+
+### RATE STORE
+
+class RateStore:
+    # Local SQLite store of daily ECB reference rates (EUR based), one row per currency and date.
+    # Nothing is opened or downloaded until the first conversion asks for a rate, and only
+    # the currencies actually used are read into memory. convert() follows the same rules as
+    # CurrencyConverter(fallback_on_wrong_date=True, fallback_on_missing_rate=True), so it
+    # can be used wherever the converter was used.
+    def __init__(self, db_path=RATES_DB_PATH, offline=None, seed_file=BUNDLED_RATES_FILE):
+        if offline is None:
+            offline = os.environ.get('AUTOBANKING_OFFLINE', '') not in ('', '0')
+        self.db_path = db_path
+        self.offline = offline
+        self.seed_file = seed_file
+        self._lock = threading.Lock()
+        self._rates = {}  # currency -> (sorted date ordinals, rates)
+        self._last_date = None
+        self._refreshed = False
+
+    def _connect(self):
+        connection = sqlite3.connect(self.db_path)
+        connection.execute('CREATE TABLE IF NOT EXISTS rates (currency TEXT, date TEXT, rate REAL, PRIMARY KEY (currency, date)) WITHOUT ROWID')
+        connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        return connection
+
+    # Insert rates that are not stored yet and return how many were added
+    def _store_rates(self, connection, rates):
+        before = connection.total_changes
+        connection.executemany(
+            'INSERT OR IGNORE INTO rates (currency, date, rate) VALUES (?, ?, ?)',
+            ((currency, this_date.isoformat(), rate) for currency, this_date, rate in rates)
+        )
+        connection.commit()
+        return connection.total_changes - before
+
+    def _read_last_date(self, connection):
+        row = connection.execute('SELECT MAX(date) FROM rates').fetchone()
+        return None if row[0] is None else date.fromisoformat(row[0])
+
+    # Fill an empty store from the bundled file when possible, otherwise from the ECB
+    def _seed(self, connection):
+        if self.seed_file and os.path.isfile(self.seed_file):
+            with open(self.seed_file, 'rb') as rates_file:
+                content = rates_file.read()
+            print(f"Seeding exchange rates from {self.seed_file}")
+        elif self.offline:
+            raise RuntimeError(f"No cached exchange rates in {self.db_path} and offline mode is on")
+        else:
+            print(f"Downloading exchange rates from {ECB_HISTORY_URL}")
+            content = urlopen(ECB_HISTORY_URL).read()
+
+        self._store_rates(connection, parse_ecb_zip(content))
+
+    # Download only the rates published after the newest stored date
+    def refresh(self, connection=None):
+        if self.offline:
+            return 0
+
+        own_connection = connection is None
+        if own_connection:
+            connection = self._connect()
+
+        try:
+            last_date = self._read_last_date(connection)
+            if last_date is not None and (date.today() - last_date).days <= RECENT_FEED_DAYS:
+                rates = parse_ecb_xml(urlopen(ECB_RECENT_URL).read())
+            else:
+                rates = parse_ecb_zip(urlopen(ECB_HISTORY_URL).read())
+
+            added = self._store_rates(connection, (rate for rate in rates if last_date is None or rate[1] > last_date))
+            connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('checked_on', ?)", (date.today().isoformat(),))
+            connection.commit()
+            print(f"Exchange rates refreshed: {added} new rates")
+
+            # Drop the in-memory copies so the new dates are picked up
+            self._rates = {}
+            self._last_date = self._read_last_date(connection)
+            return added
+        finally:
+            if own_connection:
+                connection.close()
+
+    # Open the store on first use, seeding and refreshing it as needed
+    def _ensure_loaded(self, needed_date=None):
+        if self._last_date is not None and (needed_date is None or needed_date <= self._last_date or self._refreshed):
+            return
+
+        with self._lock:
+            connection = self._connect()
+            try:
+                if self._read_last_date(connection) is None:
+                    self._seed(connection)
+                self._last_date = self._read_last_date(connection)
+
+                # Fetch missing dates at most once per run and once per day
+                needs_refresh = needed_date is not None and needed_date > self._last_date
+                if needs_refresh and not self._refreshed:
+                    checked_on = connection.execute("SELECT value FROM meta WHERE key = 'checked_on'").fetchone()
+                    if not self.offline and (checked_on is None or checked_on[0] != date.today().isoformat()):
+                        try:
+                            self.refresh(connection)
+                        except Exception as e:
+                            print(f"Could not refresh exchange rates, using cached rates: {str(e)}")
+                    self._refreshed = True
+            finally:
+                connection.close()
+
+    def _load_currency(self, currency):
+        if currency not in self._rates:
+            connection = self._connect()
+            try:
+                rows = connection.execute('SELECT date, rate FROM rates WHERE currency = ? ORDER BY date', (currency,)).fetchall()
+            finally:
+                connection.close()
+            if not rows:
+                raise ValueError(f"{currency} is not a supported currency")
+            self._rates[currency] = ([date.fromisoformat(day).toordinal() for day, _ in rows], [rate for _, rate in rows])
+        return self._rates[currency]
+
+    # EUR based rate of a currency on a date.
+    # Dates outside the stored range use the first/last known rate, and gaps such as
+    # weekends are linearly interpolated between the closest known rates.
+    def get_rate(self, currency, this_date):
+        if currency == REF_CURRENCY:
+            return 1.0
+
+        ordinals, rates = self._load_currency(currency)
+        ordinal = this_date.toordinal()
+        position = bisect_left(ordinals, ordinal)
+
+        if position == len(ordinals):
+            return rates[-1]
+        if ordinals[position] == ordinal or position == 0:
+            return rates[position]
+
+        d0 = ordinal - ordinals[position - 1]
+        d1 = ordinals[position] - ordinal
+        return (rates[position - 1] * d1 + rates[position] * d0) / (d0 + d1)
+
+    def convert(self, amount, currency, new_currency=REF_CURRENCY, this_date=None):
+        if this_date is None:
+            this_date = date.today()
+        elif isinstance(this_date, datetime):
+            this_date = this_date.date()
+
+        self._ensure_loaded(this_date)
+
+        r0 = self.get_rate(currency, this_date)
+        r1 = self.get_rate(new_currency, this_date)
+        return amount / r0 * r1
+
+
+### BATCH CONVERSION
+
+# Resolve the rate for one (currency, date) pair, returning NaN when the converter fails
+def _resolve_rate(converter, currency, target_currency, this_date):
+    try:
+        # Same currency needs no rates, so DKK-only imports never open the rate store
+        if currency == target_currency:
+            return 1.0
+        if pd.isna(this_date):
+            return np.nan
+        return converter.convert(1.00, currency, target_currency, this_date.date())
+    except Exception:
+        return np.nan
+
+
+# Build a lookup table with one exchange rate per distinct (Currency, Date) pair
+def build_rate_table(df, converter, target_currency=TARGET_CURRENCY, date_format='%d-%m-%Y'):
+    pairs = df[['Currency', 'Date']].astype({'Currency': object}).drop_duplicates().reset_index(drop=True)
+
+    # Dates are normally datetime64 already; text dates are parsed once per distinct pair
+    dates = pairs['Date']
+    if not pd.api.types.is_datetime64_any_dtype(dates):
+        dates = pd.to_datetime(dates, format=date_format, errors='coerce')
+
+    pairs['Rate'] = [
+        _resolve_rate(converter, currency, target_currency, this_date)
+        for currency, this_date in zip(pairs['Currency'], dates)
+    ]
+    return pairs
+
+
+# Convert 'Amount_currency' to the target currency for a whole DataFrame at once.
+# Sets 'Amount' and 'Currency_Rate' (both rounded to 2 decimals) with column operations,
+# and calls the converter only once per distinct (Currency, Date) pair.
+def convert_currency_batch(df, converter, target_currency=TARGET_CURRENCY, date_format='%d-%m-%Y'):
+    with stage('currency_conversion') as info:
+        rate_table = build_rate_table(df, converter, target_currency, date_format)
+
+        # Left merge keeps the row order of df, so the rates line up positionally
+        rates = df[['Currency', 'Date']].astype({'Currency': object}).merge(rate_table, on=['Currency', 'Date'], how='left')['Rate'].to_numpy()
+
+        amounts = pd.to_numeric(df['Amount_currency'], errors='coerce').to_numpy(dtype=float)
+
+        df['Amount'] = np.round(amounts * rates, 2)
+        df['Currency_Rate'] = np.round(rates, 2)
+        info.update(rows_in=len(df), rate_lookups=len(rate_table))
+    return df
@@ -0,0 +1,251 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from bank_formats import detect_bank
+from categorizer import RuleTrie
+from category_cache import CategoryCache
+from dedup_index import DedupIndex
+from excel_export import export_monthly_workbooks
+from ledger import LedgerStore
+from main import (categorize_transactions, extract_statement, load_categorization_rules,
+                  process_and_export_data, update_existing_category)
+from rollups import SUMMARY_GROUPS, RollupStore
+from run_report import finish_run, report_path, start_run
+from transfers import match_ledger_transfers
+
+# Only reachable from this machine
+HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+# Seconds the client waits for an answer (a first import may convert a lot of currencies)
+CLIENT_TIMEOUT = 600
+
+
+### SERVICE
+
+class AutoBankingService:
+    # Everything a run of main.py rebuilds from scratch, kept alive between imports: pandas
+    # and the other libraries stay imported, the rate store keeps the currencies it has
+    # loaded (main.c), the compiled rule trie, the rules state and the category cache stay in
+    # memory, and the UniqueID index keeps one connection open. The rules file is only read
+    # and compiled again when its modification time changes, and the ledger is only
+    # re-categorized then, with the trie already compiled.
+    def __init__(self, ledger_dir, categorization_rules_path, excel_dir=None, report_dir=None):
+        self.ledger_dir = ledger_dir
+        self.categorization_rules_path = os.path.abspath(categorization_rules_path)
+        self.excel_dir = excel_dir
+        self.report_dir = report_dir
+        self.category_cache = CategoryCache(ledger_dir)
+        self.dedup_index = DedupIndex(ledger_dir, keep_open=True)
+        self.rule_trie = None
+        self.rules_state = None
+        self.started = time.time()
+        self.requests = 0
+        self._rules_mtime = None
+        self._recategorized_mtime = None
+
+    # The compiled rules, recompiled only if the file changed on disk
+    def rules(self):
+        mtime = os.stat(self.categorization_rules_path).st_mtime_ns
+        if mtime != self._rules_mtime:
+            self.rule_trie = RuleTrie(load_categorization_rules(self.categorization_rules_path))
+            self._rules_mtime = mtime
+            print(f"Loaded {len(self.rule_trie.rules)} categorization rules from {self.categorization_rules_path}")
+        return self.rule_trie
+
+    def recategorize(self):
+        self.rules()
+        if self._recategorized_mtime == self._rules_mtime:
+            print("Categorization rules unchanged. Skipping category update.")
+            return {'updated': False}
+        state = update_existing_category(self.ledger_dir, self.categorization_rules_path, self.category_cache, self.rule_trie, self.rules_state)
+        if state is None:
+            # The error was printed; try again with the next command
+            return {'updated': False}
+        self.rules_state = state
+        self._recategorized_mtime = self._rules_mtime
+        return {'updated': True}
+
+    def import_statement(self, file_path, bank=None):
+        bank = bank or detect_bank(file_path)
+        if bank is None:
+            raise ValueError(f"{file_path} does not look like a statement of a known bank. Pass the bank explicitly.")
+
+        transactions = extract_statement(file_path, bank, LedgerStore(self.ledger_dir).id_scheme(), strict=True)
+        categorized = categorize_transactions(transactions, self.rules(), self.category_cache)
+        self.recategorize()
+        # An export failure is reported to the client instead of an empty result
+        appended = process_and_export_data(categorized, self.ledger_dir, dedup_index=self.dedup_index, strict=True)
+        transfers = match_ledger_transfers(self.ledger_dir, keys=list(appended))
+
+        if self.excel_dir:
+            export_monthly_workbooks(self.ledger_dir, self.excel_dir)
+
+        return {'bank': bank, 'rows': len(transactions), 'appended': appended, 'transfers': transfers}
+
+    # Monthly (or yearly) totals from the materialized rollups, as a list of rows
+    def summary(self, year=None, months=None, by='category', yearly=False):
+        rollups = RollupStore(self.ledger_dir)
+        summary = rollups.yearly_summary(year, by) if yearly else rollups.monthly_summary(year, months, by)
+        return summary.to_dict(orient='records')
+
+    def status(self):
+        return {
+            'ledger': self.ledger_dir,
+            'rules_file': self.categorization_rules_path,
+            'rules': None if self.rule_trie is None else len(self.rule_trie.rules),
+            'category_cache': self.category_cache.stats(),
+            'uptime_seconds': round(time.time() - self.started, 1),
+            'requests': self.requests,
+        }
+
+    # Run one command; returns (result, captured output). A failing command is reported to
+    # the client instead of stopping the service.
+    def handle(self, command, arguments):
+        commands = {
+            'import': lambda: self.import_statement(os.path.abspath(arguments['file']), arguments.get('bank')),
+            'recategorize': self.recategorize,
+            'summary': lambda: self.summary(arguments.get('year'), arguments.get('months'), arguments.get('by', 'category'), arguments.get('yearly', False)),
+            'status': self.status,
+        }
+        if command not in commands:
+            raise KeyError(f"Unknown command: {command}")
+
+        self.requests += 1
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            if self.report_dir and command != 'status':
+                start_run()
+            try:
+                result = commands[command]()
+            finally:
+                if self.report_dir and command != 'status':
+                    finish_run(report_path(self.report_dir))
+        return result, output.getvalue()
+
+
+### HTTP
+
+# One request at a time (HTTPServer is single-threaded), so commands never overlap
+class _RequestHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def do_POST(self):
+        started = time.perf_counter()
+        command = self.path.strip('/')
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            arguments = json.loads(self.rfile.read(length) or b'{}')
+            if command == 'stop':
+                result, output = {'stopping': True}, ''
+            else:
+                result, output = self.service.handle(command, arguments)
+            response = {'ok': True, 'result': result, 'output': output}
+        except Exception as e:
+            response = {'ok': False, 'error': f"{type(e).__name__}: {str(e)}"}
+        response['seconds'] = round(time.perf_counter() - started, 4)
+
+        body = json.dumps(response, default=str).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+        if command == 'stop':
+            # shutdown() waits for serve_forever, which is running this handler
+            threading.Thread(target=self.server.shutdown).start()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(ledger_dir, categorization_rules_path, excel_dir=None, report_dir=None, port=DEFAULT_PORT):
+    service = AutoBankingService(ledger_dir, categorization_rules_path, excel_dir, report_dir)
+    # Compile the rules before the first import asks for them
+    service.rules()
+
+    handler = type('RequestHandler', (_RequestHandler,), {'service': service})
+    server = HTTPServer((HOST, port), handler)
+    print(f"AutoBanking service for {ledger_dir} listening on http://{HOST}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.dedup_index.close()
+        print("AutoBanking service stopped")
+
+
+### CLIENT
+
+# Send one command to a running service and return its JSON response
+def send_command(command, arguments=None, port=DEFAULT_PORT):
+    request = urllib.request.Request(f'http://{HOST}:{port}/{command}', data=json.dumps(arguments or {}).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'}, method='POST')
+    with urllib.request.urlopen(request, timeout=CLIENT_TIMEOUT) as response:
+        return json.loads(response.read())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep AutoBanking running between imports, or send it commands")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help="start the service")
+    serve_parser.add_argument('--ledger', required=True, help="ledger directory")
+    serve_parser.add_argument('--rules', default='categorization_rules.json', help="categorization rules JSON file")
+    serve_parser.add_argument('--excel', help="rebuild the monthly Excel workbooks of changed months in this directory")
+    serve_parser.add_argument('--run-reports', help="write a run report for every command into this directory")
+
+    import_parser = subparsers.add_parser('import', help="import a statement")
+    import_parser.add_argument('file')
+    import_parser.add_argument('--bank', help="bank format (default: detected from the file)")
+
+    subparsers.add_parser('recategorize', help="re-categorize the ledger if the rules changed")
+
+    summary_parser = subparsers.add_parser('summary', help="monthly or yearly totals")
+    summary_parser.add_argument('--year', help="only this year (YYYY)")
+    summary_parser.add_argument('--month', action='append', help="only this month (YYYY-MM); can be repeated")
+    summary_parser.add_argument('--by', choices=list(SUMMARY_GROUPS), default='category')
+    summary_parser.add_argument('--yearly', action='store_true', help="totals per year instead of per month")
+
+    subparsers.add_parser('status', help="show what the service has loaded")
+    subparsers.add_parser('stop', help="stop the service")
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.ledger, args.rules, args.excel, args.run_reports, args.port)
+        return
+
+    arguments = {}
+    if args.command == 'import':
+        arguments = {'file': os.path.abspath(args.file), 'bank': args.bank}
+    elif args.command == 'summary':
+        arguments = {'year': args.year, 'months': args.month, 'by': args.by, 'yearly': args.yearly}
+    try:
+        response = send_command(args.command, arguments, args.port)
+    except urllib.error.URLError as e:
+        print(f"Could not reach the AutoBanking service on port {args.port} ({e.reason}). Start it with: python daemon.py serve --ledger ...")
+        return
+
+    if response.get('output'):
+        print(response['output'], end='')
+    if response['ok']:
+        print(json.dumps(response['result'], indent=4, default=str))
+    else:
+        print(f"An error occurred in the service: {response['error']}")
+    print(f"({response['seconds']:.3f}s)")
+
+
+if __name__ == "__main__":
+    main()
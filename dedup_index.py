@@ -0,0 +1,128 @@
+import contextlib
+import os
+import sqlite3
+
+import pandas as pd
+
+from ledger import LedgerStore, partition_keys
+
+INDEX_FILE = '_ids.sqlite'
+
+
+class DedupIndex:
+    # Persistent set of every UniqueID in a ledger, kept in SQLite next to the partitions.
+    # Lookups cost O(batch size) index probes instead of loading the ledger, and the
+    # index is rebuilt from the partitions if the file goes missing.
+    # Each ID can carry the token of the import that wrote it (a streamed statement), so later
+    # batches of the same import can tell their own rows from the history without keeping
+    # every ID of the stream in memory.
+    # keep_open=True holds one connection until close(), for callers that look up many
+    # batches (a streamed import, the daemon) instead of connecting for each one.
+    def __init__(self, ledger_dir, keep_open=False):
+        self.ledger_dir = ledger_dir
+        self.index_path = os.path.join(ledger_dir, INDEX_FILE)
+        self._connection = None
+
+        if not os.path.isfile(self.index_path):
+            self.rebuild()
+        if keep_open:
+            self._connection = self._connect()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.index_path)
+        connection.execute('CREATE TABLE IF NOT EXISTS ids (unique_id TEXT PRIMARY KEY, partition TEXT, import_token TEXT) WITHOUT ROWID')
+        # Indexes built before import tokens existed
+        if 'import_token' not in {row[1] for row in connection.execute('PRAGMA table_info(ids)')}:
+            connection.execute('ALTER TABLE ids ADD COLUMN import_token TEXT')
+        connection.execute('CREATE INDEX IF NOT EXISTS ids_import_token ON ids (import_token) WHERE import_token IS NOT NULL')
+        return connection
+
+    # The kept connection, or a new one that is closed again afterwards
+    @contextlib.contextmanager
+    def _connected(self):
+        connection = self._connection if self._connection is not None else self._connect()
+        try:
+            yield connection
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            if connection is not self._connection:
+                connection.close()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    # Recreate the index from the UniqueID column of every ledger partition
+    def rebuild(self):
+        store = LedgerStore(self.ledger_dir)
+        temp_path = self.index_path + '.tmp'
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+        connection = sqlite3.connect(temp_path)
+        try:
+            connection.execute('CREATE TABLE ids (unique_id TEXT PRIMARY KEY, partition TEXT, import_token TEXT) WITHOUT ROWID')
+            for key in store.partitions():
+                ids = store.read_partition(key, columns=['UniqueID'])['UniqueID'].astype(str)
+                connection.executemany('INSERT OR IGNORE INTO ids VALUES (?, ?, NULL)', ((unique_id, key) for unique_id in ids))
+            connection.commit()
+        finally:
+            connection.close()
+
+        os.replace(temp_path, self.index_path)
+        print(f"Rebuilt UniqueID index for {self.ledger_dir}")
+
+    # {UniqueID: import token} for those of the given IDs already in the ledger
+    def _lookup(self, unique_ids):
+        with self._connected() as connection:
+            connection.execute('CREATE TEMP TABLE batch (unique_id TEXT PRIMARY KEY) WITHOUT ROWID')
+            try:
+                connection.executemany('INSERT OR IGNORE INTO batch VALUES (?)', ((unique_id,) for unique_id in unique_ids.unique()))
+                return dict(connection.execute('SELECT batch.unique_id, ids.import_token FROM batch JOIN ids USING (unique_id)'))
+            finally:
+                # End the read transaction, so a kept connection does not block other writers
+                connection.rollback()
+                connection.execute('DROP TABLE temp.batch')
+
+    # Boolean Series telling which of the given IDs are already in the ledger
+    def contains(self, unique_ids):
+        unique_ids = pd.Series(unique_ids, dtype=object).astype(str)
+        if unique_ids.empty:
+            return pd.Series(False, index=unique_ids.index)
+        return unique_ids.isin(self._lookup(unique_ids))
+
+    # Record IDs that have just been written to the ledger, optionally with the token of the
+    # import that wrote them
+    def add(self, unique_ids, dates, import_token=None):
+        keys = partition_keys(dates)
+        with self._connected() as connection:
+            connection.executemany('INSERT OR IGNORE INTO ids VALUES (?, ?, ?)',
+                                   ((unique_id, key, import_token) for unique_id, key in zip(pd.Series(unique_ids, dtype=object).astype(str), keys)))
+            connection.commit()
+
+    # Clear the token of a finished import; its IDs are plain history from now on
+    def end_import(self, import_token):
+        with self._connected() as connection:
+            connection.execute('UPDATE ids SET import_token = NULL WHERE import_token = ?', (import_token,))
+            connection.commit()
+
+    # Split a batch of IDs into duplicates within the batch and duplicates of the ledger.
+    # IDs recorded with import_token were written by the same import (earlier batches of a
+    # streamed statement); they count as part of the batch rather than as history, so a
+    # stream keeps the same rows as importing the statement in one go.
+    def find_duplicates(self, unique_ids, import_token=None):
+        unique_ids = pd.Series(unique_ids, dtype=object).astype(str)
+        in_batch = unique_ids.duplicated(keep='first')
+        if unique_ids.empty:
+            return in_batch, pd.Series(False, index=unique_ids.index)
+
+        found = self._lookup(unique_ids)
+        in_history = unique_ids.isin(found)
+        if import_token is not None:
+            earlier = unique_ids.map(found).eq(import_token)
+            in_batch |= earlier
+            in_history &= ~earlier
+        return in_batch, in_history
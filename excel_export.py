@@ -0,0 +1,151 @@
+import importlib.util
+import json
+import os
+
+from ledger import LedgerStore
+from run_report import stage
+
+HAS_XLSXWRITER = importlib.util.find_spec('xlsxwriter') is not None
+
+EXPORT_STATE_FILE = '_exported.json'
+
+# Columns of the Transactions sheet, in order, with their column widths
+TRANSACTION_SHEET_COLUMNS = {
+    'Date': 12,
+    'Description': 40,
+    'Amount': 14,
+    'Amount_currency': 16,
+    'Currency': 10,
+    'Currency_Rate': 14,
+    'Bank': 20,
+    'Main Category': 22,
+    'Sub Category': 22,
+    'Transfer': 20,
+}
+AMOUNT_COLUMNS = ('Amount', 'Amount_currency')
+
+DATE_FORMAT = 'dd-mm-yyyy'
+NUMBER_FORMAT = '#,##0.00'
+
+
+### WORKBOOK
+
+# Totals per category for the Summary sheet: one row per (Main Category, Sub Category)
+def category_summary(df):
+    categories = df[['Main Category', 'Sub Category']].astype(object).fillna('Uncategorized')
+    summary = df.assign(**{column: categories[column] for column in categories}).groupby(
+        ['Main Category', 'Sub Category'], sort=True).agg(
+        Transactions=('Amount', 'size'), Income=('Amount', lambda amounts: amounts[amounts > 0].sum()),
+        Expenses=('Amount', lambda amounts: amounts[amounts < 0].sum()), Total=('Amount', 'sum'))
+    return summary.reset_index()
+
+
+# Write one month to a workbook with a Summary and a Transactions sheet.
+# xlsxwriter's constant_memory mode flushes every row to disk as soon as the next row
+# starts, so memory use does not grow with the number of transactions.
+def write_month_workbook(df, path):
+    import xlsxwriter
+
+    df = df.sort_values('Date', kind='stable').reindex(columns=list(TRANSACTION_SHEET_COLUMNS))
+
+    temp_path = path + '.tmp'
+    workbook = xlsxwriter.Workbook(temp_path, {'constant_memory': True, 'default_date_format': DATE_FORMAT})
+    header_format = workbook.add_format({'bold': True, 'bottom': 1})
+    number_format = workbook.add_format({'num_format': NUMBER_FORMAT})
+    total_format = workbook.add_format({'bold': True, 'top': 1, 'num_format': NUMBER_FORMAT})
+
+    # Summary first, so it is the sheet the workbook opens on
+    summary = category_summary(df)
+    summary_sheet = workbook.add_worksheet('Summary')
+    summary_sheet.set_column(0, 1, 22)
+    summary_sheet.set_column(2, 2, 14)
+    summary_sheet.set_column(3, 5, 14, number_format)
+    summary_sheet.write_row(0, 0, list(summary.columns), header_format)
+    for row_num, row in enumerate(summary.itertuples(index=False), start=1):
+        summary_sheet.write_row(row_num, 0, row)
+    totals = ['Total', '', int(summary['Transactions'].sum())] + [float(summary[column].sum()) for column in ('Income', 'Expenses', 'Total')]
+    summary_sheet.write_row(len(summary) + 1, 0, totals, total_format)
+
+    sheet = workbook.add_worksheet('Transactions')
+    for col_num, (column, width) in enumerate(TRANSACTION_SHEET_COLUMNS.items()):
+        sheet.set_column(col_num, col_num, width, number_format if column in AMOUNT_COLUMNS else None)
+    sheet.write_row(0, 0, list(TRANSACTION_SHEET_COLUMNS), header_format)
+
+    # Blank cells for missing values (NaN, NaT), everything else as its native Excel type
+    values = df.astype(object).where(df.notna(), None)
+    for row_num, row in enumerate(values.itertuples(index=False), start=1):
+        sheet.write_row(row_num, 0, row)
+    sheet.autofilter(0, 0, len(df), len(TRANSACTION_SHEET_COLUMNS) - 1)
+
+    workbook.close()
+    os.replace(temp_path, path)
+
+
+### EXPORT
+
+def _read_state(export_dir):
+    try:
+        with open(os.path.join(export_dir, EXPORT_STATE_FILE), 'r') as json_file:
+            return json.load(json_file)
+    except FileNotFoundError:
+        return {}
+
+
+def _write_state(export_dir, state):
+    state_path = os.path.join(export_dir, EXPORT_STATE_FILE)
+    with open(state_path + '.tmp', 'w') as json_file:
+        json.dump(state, json_file, indent=4)
+    os.replace(state_path + '.tmp', state_path)
+
+
+# Months whose ledger partition changed since their workbook was written, and workbooks
+# whose partition no longer exists
+def changed_months(ledger_dir, export_dir):
+    store = LedgerStore(ledger_dir)
+    versions = store.versions()
+    state = _read_state(export_dir)
+    partitions = store.partitions()
+
+    changed = [key for key in partitions if state.get(key) != versions.get(key, 0)]
+    removed = [key for key in state if key not in partitions]
+    return changed, removed
+
+
+# Write one workbook per changed month (export_dir/YYYY-MM.xlsx) and return the months written.
+# months=None rebuilds only months that received new or re-categorized rows since the last export.
+def export_monthly_workbooks(ledger_dir, export_dir, months=None):
+    if not HAS_XLSXWRITER:
+        print("xlsxwriter is not installed. Skipping the Excel export.")
+        return []
+
+    try:
+        os.makedirs(export_dir, exist_ok=True)
+        store = LedgerStore(ledger_dir)
+        versions = store.versions()
+        state = _read_state(export_dir)
+
+        if months is None:
+            months, removed = changed_months(ledger_dir, export_dir)
+        else:
+            removed = []
+
+        for key in removed:
+            workbook_path = os.path.join(export_dir, f'{key}.xlsx')
+            if os.path.isfile(workbook_path):
+                os.remove(workbook_path)
+            state.pop(key, None)
+
+        with stage('excel_export', months=len(months)):
+            for key in months:
+                write_month_workbook(store.read_partition(key), os.path.join(export_dir, f'{key}.xlsx'))
+                state[key] = versions.get(key, 0)
+                # Save after every workbook, so an interrupted export resumes where it stopped
+                _write_state(export_dir, state)
+
+        _write_state(export_dir, state)
+        print(f"Excel workbooks written for {len(months)} month(s) in {export_dir}")
+        return months
+
+    except Exception as e:
+        print(f"An error occurred in export_monthly_workbooks: {str(e)}")
+        return []
@@ -0,0 +1,374 @@
+import json
+import os
+import re
+import shutil
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from bank_formats import hashed_unique_ids
+from unique_ids import ID_SCHEME, ID_SCHEME_VARIABLE, ID_SCHEMES, detect_id_scheme
+
+# 'Rule' holds the lower-cased keyword that categorized the row ('' when uncategorized)
+LEDGER_COLUMNS = ['Date', 'Description', 'Amount', 'Amount_currency', 'Currency', 'Currency_Rate', 'Bank', 'UniqueID', 'Main Category', 'Sub Category', 'Rule']
+
+# Same CSV dialect as the old output.csv, so every partition opens directly in Danish Excel
+CSV_OPTIONS = {'sep': ';', 'decimal': ',', 'encoding': 'utf-8'}
+
+# Dates are datetime64 in memory and only formatted like this when a partition is written
+DISPLAY_DATE_FORMAT = '%d-%m-%Y'
+
+# Columns read back as pandas categoricals
+CATEGORY_COLUMNS = ['Currency', 'Bank', 'Main Category', 'Sub Category']
+
+# Text columns whose values can look like numbers (a keyword '24', an all-digit ID); read as
+# text so they compare equal to the strings they were written from
+TEXT_COLUMNS = ['Description', 'UniqueID', 'Rule', 'Transfer']
+
+UNDATED_PARTITION = 'undated'
+MANIFEST_FILE = '_manifest.json'
+
+_PARTITION_FILE = re.compile(r'^(\d{4}-\d{2}|' + UNDATED_PARTITION + r')\.csv$')
+
+# Serializes writes to partition files, including background compaction
+_write_lock = threading.RLock()
+
+# Windows refuses to replace a file another program (usually Excel) has open
+REPLACE_ATTEMPTS = 5
+REPLACE_DELAY = 0.5
+
+
+# Map dates (datetime64, or 'DD-MM-YYYY' text) to their 'YYYY-MM' partition key
+def partition_keys(dates):
+    dates = pd.Series(dates)
+    if not pd.api.types.is_datetime64_any_dtype(dates):
+        dates = pd.to_datetime(dates.astype(object), format=DISPLAY_DATE_FORMAT, errors='coerce')
+    return dates.dt.strftime('%Y-%m').astype(object).where(dates.notna(), UNDATED_PARTITION)
+
+
+# Read a ledger CSV into the internal types: datetime64 dates and categorical text columns
+def read_ledger_csv(path, columns=None):
+    dtypes = {column: str for column in TEXT_COLUMNS}
+    dtypes.update({column: 'category' for column in CATEGORY_COLUMNS if columns is None or column in columns})
+    df = pd.read_csv(path, usecols=columns, dtype=dtypes, **CSV_OPTIONS)
+    if 'Date' in df.columns:
+        df['Date'] = pd.to_datetime(df['Date'], format=DISPLAY_DATE_FORMAT, errors='coerce')
+    return df
+
+
+# Write a ledger CSV, formatting dates for display only here
+def write_ledger_csv(df, path, append=False):
+    df.to_csv(path, mode='a' if append else 'w', header=not append, index=False, date_format=DISPLAY_DATE_FORMAT, **CSV_OPTIONS)
+
+
+# Move a finished temporary file over its target in one step. Readers see either the old
+# or the new file, never a half-written one, and a failed write leaves the ledger untouched.
+def replace_file(temp_path, path):
+    for attempt in range(REPLACE_ATTEMPTS):
+        try:
+            os.replace(temp_path, path)
+            return
+        except PermissionError:
+            if attempt == REPLACE_ATTEMPTS - 1:
+                raise PermissionError(f"Cannot replace {path}. Close it in other programs (e.g. Excel) and try again.")
+            time.sleep(REPLACE_DELAY)
+
+
+# Delete a file if it exists. quiet=True only reports a failure, for clean-up that must
+# not stop what comes after it.
+def remove_file(path, quiet=False):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        if not quiet:
+            raise
+        print(f"An error occurred while removing {path}: {str(e)}")
+
+
+class LedgerStore:
+    # Transaction ledger stored as one CSV file per month (YYYY-MM.csv) in a directory.
+    # New transactions are appended to the partitions of their month only, so an import
+    # never rereads or rewrites the rest of the history. Appended partitions are marked
+    # dirty in the manifest and sorted by date later by compact().
+    # The manifest also counts a version per partition that goes up whenever rows are added
+    # or changed (but not when compaction only reorders them), so derived outputs such as
+    # the Excel workbooks can tell which months need rebuilding.
+    def __init__(self, ledger_dir):
+        self.ledger_dir = ledger_dir
+        os.makedirs(ledger_dir, exist_ok=True)
+
+    def partition_path(self, key):
+        return os.path.join(self.ledger_dir, f'{key}.csv')
+
+    def partitions(self):
+        return sorted(match.group(1) for match in map(_PARTITION_FILE.match, os.listdir(self.ledger_dir)) if match)
+
+    def partition_paths(self):
+        return [self.partition_path(key) for key in self.partitions()]
+
+    def is_empty(self):
+        return not self.partitions()
+
+    ### MANIFEST
+
+    def _manifest_path(self):
+        return os.path.join(self.ledger_dir, MANIFEST_FILE)
+
+    def read_manifest(self):
+        try:
+            with open(self._manifest_path(), 'r') as manifest_file:
+                return json.load(manifest_file)
+        except FileNotFoundError:
+            return {'dirty': []}
+
+    def write_manifest(self, manifest):
+        temp_path = self._manifest_path() + '.tmp'
+        with open(temp_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=4)
+        os.replace(temp_path, self._manifest_path())
+
+    def _mark_dirty(self, keys):
+        manifest = self.read_manifest()
+        manifest['dirty'] = sorted(set(manifest.get('dirty', [])) | set(keys))
+        self._bump_versions(manifest, keys)
+        self.write_manifest(manifest)
+
+    def _bump_versions(self, manifest, keys):
+        versions = manifest.setdefault('versions', {})
+        for key in keys:
+            versions[key] = versions.get(key, 0) + 1
+
+    # {partition: version}; partitions written before versions were tracked are missing
+    def versions(self):
+        return self.read_manifest().get('versions', {})
+
+    # UniqueID scheme of this ledger (see unique_ids). It is recorded in the manifest the
+    # first time it is asked for: from the stored IDs for an existing ledger, otherwise the
+    # requested scheme (or AUTOBANKING_ID_SCHEME). A different requested scheme is refused,
+    # because its IDs never match the ledger's and every row would be imported again.
+    def id_scheme(self, requested=None):
+        requested = requested or os.environ.get(ID_SCHEME_VARIABLE)
+        if requested is not None and requested not in ID_SCHEMES:
+            raise ValueError(f"Unsupported UniqueID scheme: {requested}")
+
+        with _write_lock:
+            manifest = self.read_manifest()
+            scheme = manifest.get('id_scheme')
+            if scheme is None:
+                keys = self.partitions()
+                # The first partition with IDs we hashed (bank-supplied IDs say nothing about the scheme)
+                for key in keys:
+                    scheme = detect_id_scheme(hashed_unique_ids(self.read_partition(key, columns=['Bank', 'UniqueID'])))
+                    if scheme is not None:
+                        break
+                scheme = scheme or requested or ID_SCHEME
+                manifest['id_scheme'] = scheme
+                self.write_manifest(manifest)
+
+        if requested is not None and requested != scheme:
+            raise ValueError(f"The ledger in {self.ledger_dir} uses '{scheme}' UniqueIDs, not '{requested}'. "
+                             f"Unset {ID_SCHEME_VARIABLE} or start a new ledger for '{requested}'.")
+        return scheme
+
+    ### READING
+
+    def _read_header(self, key):
+        with open(self.partition_path(key), 'r', encoding=CSV_OPTIONS['encoding']) as partition_file:
+            return partition_file.readline().rstrip('\r\n').split(CSV_OPTIONS['sep'])
+
+    # Column names of a partition, from its header line only
+    def partition_columns(self, key):
+        return self._read_header(key)
+
+    def read_partition(self, key, columns=None):
+        path = self.partition_path(key)
+        if not os.path.isfile(path):
+            return pd.DataFrame(columns=columns or LEDGER_COLUMNS)
+        return read_ledger_csv(path, columns)
+
+    def read_all(self, columns=None, keys=None):
+        keys = self.partitions() if keys is None else keys
+        frames = [self.read_partition(key, columns) for key in keys]
+        if not frames:
+            return pd.DataFrame(columns=columns or LEDGER_COLUMNS)
+
+        # Partitions have different category sets, so concat falls back to text; restore them
+        df = pd.concat(frames, ignore_index=True)
+        for column in CATEGORY_COLUMNS:
+            if column in df.columns:
+                df[column] = df[column].astype('category')
+        return df
+
+    # UniqueIDs stored in the given partitions
+    def read_ids(self, keys):
+        existing = [key for key in keys if os.path.isfile(self.partition_path(key))]
+        return self.read_all(columns=['UniqueID'], keys=existing)['UniqueID'].astype(str)
+
+    ### WRITING
+
+    # Replace a partition in one step: write a temporary file and rename it over the old one.
+    # changed=False is for rewrites that keep the same rows, such as sorting.
+    def write_partition(self, key, df, changed=True):
+        path = self.partition_path(key)
+        temp_path = path + '.tmp'
+        with _write_lock:
+            write_ledger_csv(df, temp_path)
+            replace_file(temp_path, path)
+
+            if changed:
+                manifest = self.read_manifest()
+                self._bump_versions(manifest, [key])
+                self.write_manifest(manifest)
+
+    # Set one column for the rows with the given UniqueIDs and return the number of rows set.
+    # Rows are found by UniqueID and the partition is read and written under the write lock,
+    # so a background compaction can neither reorder the rows in between nor undo the change.
+    def set_values(self, key, column, ids, values):
+        with _write_lock:
+            df = self.read_partition(key)
+            new_values = pd.Series(list(values), index=pd.Index(ids, dtype=object).astype(str))
+            new_values = new_values[~new_values.index.duplicated()]
+            mapped = df['UniqueID'].astype(str).map(new_values)
+
+            current = df[column].astype(object) if column in df.columns else pd.Series(None, index=df.index, dtype=object)
+            df[column] = current.where(mapped.isna(), mapped)
+            self.write_partition(key, df)
+            return int(mapped.notna().sum())
+
+    # Rename every prepared (temp_path, path) pair over its target, or none of them. Each
+    # existing partition is kept as a .bak (a hard link where the file system allows it)
+    # until all renames are done; if one fails, the partitions replaced so far are restored,
+    # new ones removed, and the remaining temporary files deleted.
+    def _replace_all(self, prepared):
+        replaced = []
+        backup_path = None
+        try:
+            for temp_path, path in prepared:
+                backup_path = None
+                if os.path.isfile(path):
+                    backup_path = path + '.bak'
+                    remove_file(backup_path)
+                    try:
+                        os.link(path, backup_path)
+                    except OSError:
+                        shutil.copyfile(path, backup_path)
+                replace_file(temp_path, path)
+                replaced.append((path, backup_path))
+                backup_path = None
+        except Exception:
+            # The partition that failed was never replaced; only its backup is left over
+            if backup_path is not None:
+                remove_file(backup_path, quiet=True)
+            # Each step on its own, so one that fails does not stop the rest of the rollback
+            for path, replaced_backup in reversed(replaced):
+                try:
+                    if replaced_backup is not None:
+                        replace_file(replaced_backup, path)
+                    else:
+                        os.remove(path)
+                except Exception as e:
+                    kept = f" (the original is kept as {replaced_backup})" if replaced_backup is not None else ""
+                    print(f"An error occurred while restoring {path}: {str(e)}{kept}")
+            for temp_path, _ in prepared:
+                remove_file(temp_path, quiet=True)
+            raise
+
+        for _, replaced_backup in replaced:
+            if replaced_backup is not None:
+                remove_file(replaced_backup, quiet=True)
+
+    # Append rows to their month partitions and return {partition: rows appended}.
+    # Every touched partition is first written in full to a temporary file (a byte copy of
+    # the old file plus the new rows); only when all of them are ready are they renamed
+    # over the originals, all or none (see _replace_all), so a failure never leaves some
+    # partitions appended. The manifest is only updated once every rename has succeeded.
+    def append(self, df):
+        if df.empty:
+            return {}
+
+        columns = LEDGER_COLUMNS + [column for column in df.columns if column not in LEDGER_COLUMNS]
+        df = df.reindex(columns=columns)
+        appended = {}
+        prepared = []
+
+        with _write_lock:
+            try:
+                for key, rows in df.groupby(partition_keys(df['Date']).to_numpy(), sort=True):
+                    path = self.partition_path(key)
+                    temp_path = path + '.tmp'
+                    prepared.append((temp_path, path))
+
+                    if os.path.isfile(path):
+                        header = self._read_header(key)
+                        if set(header) >= set(columns):
+                            # Appending is only safe when the file already has every column
+                            shutil.copyfile(path, temp_path)
+                            write_ledger_csv(rows.reindex(columns=header), temp_path, append=True)
+                        else:
+                            # Older partition without a newer column: rewrite it once with the wider schema
+                            existing = self.read_partition(key)
+                            merged_columns = header + [column for column in columns if column not in header]
+                            write_ledger_csv(pd.concat([existing, rows], ignore_index=True).reindex(columns=merged_columns), temp_path)
+                    else:
+                        write_ledger_csv(rows, temp_path)
+
+                    appended[key] = len(rows)
+            except Exception:
+                for temp_path, _ in prepared:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+                raise
+
+            self._replace_all(prepared)
+            self._mark_dirty(appended)
+
+        return appended
+
+    ### COMPACTION
+
+    # Sort dirty partitions by date so appended rows end up in order
+    def compact(self, keys=None):
+        with _write_lock:
+            manifest = self.read_manifest()
+            dirty = set(manifest.get('dirty', []))
+            keys = sorted(dirty if keys is None else set(keys) & dirty)
+
+            for key in keys:
+                if os.path.isfile(self.partition_path(key)):
+                    df = self.read_partition(key)
+                    order = np.argsort(df['Date'].to_numpy(), kind='stable')
+                    self.write_partition(key, df.iloc[order], changed=False)
+
+            manifest['dirty'] = sorted(dirty - set(keys))
+            self.write_manifest(manifest)
+
+        return keys
+
+    # Compact in a separate thread so the import can finish without waiting for it.
+    # on_done(keys) runs in the same thread once the partitions are sorted.
+    def compact_in_background(self, keys=None, on_done=None):
+        def run():
+            compacted = self.compact(keys)
+            if on_done is not None:
+                on_done(compacted)
+
+        thread = threading.Thread(target=run, name='ledger-compaction')
+        thread.start()
+        return thread
+
+    ### MIGRATION
+
+    # Split an old single-file output.csv into month partitions (only into an empty ledger)
+    def import_legacy_csv(self, csv_file_path):
+        if not self.is_empty() or not os.path.isfile(csv_file_path) or os.path.getsize(csv_file_path) == 0:
+            return {}
+
+        df = read_ledger_csv(csv_file_path)
+        print(f"Moving {len(df)} rows from {csv_file_path} into the ledger at {self.ledger_dir}")
+        appended = self.append(df)
+        self.compact()
+        return appended
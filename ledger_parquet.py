@@ -0,0 +1,146 @@
+import importlib.util
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import pandas as pd
+
+from ledger import LedgerStore, UNDATED_PARTITION
+
+HAS_PYARROW = importlib.util.find_spec('pyarrow') is not None
+
+MIRROR_DIR = '_parquet'
+SYNC_STATE_FILE = '_synced.json'
+
+# Directory partition fields added by the mirror (year=2024/month=2/bank=Wise)
+PARTITION_FIELDS = ['year', 'month', 'bank']
+
+# Syncs run both in the import and in the background compaction thread; one at a time, so
+# they never swap the same month directory or overwrite each other's sync state
+_sync_lock = threading.Lock()
+
+
+class ParquetMirror:
+    # Columnar copy of the CSV ledger for analytics, stored as Hive-style Parquet
+    # directories: <ledger>/_parquet/year=YYYY/month=M/bank=<Bank>/part.parquet.
+    # Each CSV month partition maps to one month directory, so keeping the mirror
+    # current after an import only rewrites the months that import touched.
+    # The CSV partitions stay the source of truth and the human-editable copy.
+    def __init__(self, ledger_dir, mirror_dir=None):
+        self.store = LedgerStore(ledger_dir)
+        self.mirror_dir = mirror_dir or os.path.join(ledger_dir, MIRROR_DIR)
+
+    def _month_dir(self, key):
+        if key == UNDATED_PARTITION:
+            year, month = 0, 0
+        else:
+            year, month = int(key[:4]), int(key[5:7])
+        return os.path.join(self.mirror_dir, f'year={year}', f'month={month}')
+
+    ### SYNC STATE
+
+    def _state_path(self):
+        return os.path.join(self.mirror_dir, SYNC_STATE_FILE)
+
+    def _read_state(self):
+        try:
+            with open(self._state_path(), 'r') as json_file:
+                return json.load(json_file)
+        except FileNotFoundError:
+            return {}
+
+    def _write_state(self, state):
+        os.makedirs(self.mirror_dir, exist_ok=True)
+        with open(self._state_path() + '.tmp', 'w') as json_file:
+            json.dump(state, json_file, indent=4)
+        os.replace(self._state_path() + '.tmp', self._state_path())
+
+    def _signature(self, key):
+        stat = os.stat(self.store.partition_path(key))
+        return [stat.st_size, stat.st_mtime_ns]
+
+    ### WRITING
+
+    # Rewrite the Parquet files of the given month partitions from their CSV files
+    def sync(self, keys):
+        with _sync_lock:
+            state = self._read_state()
+
+            for key in sorted(set(keys)):
+                month_dir = self._month_dir(key)
+                os.makedirs(os.path.dirname(month_dir), exist_ok=True)
+                # A fresh directory per sync; the leading '_' keeps readers from picking up a
+                # half-written month
+                temp_dir = tempfile.mkdtemp(prefix='_' + os.path.basename(month_dir) + '.', suffix='.tmp', dir=os.path.dirname(month_dir))
+
+                try:
+                    if os.path.isfile(self.store.partition_path(key)):
+                        # Signature first: if the CSV changes while it is read, the month shows up as stale
+                        signature = self._signature(key)
+                        df = self.store.read_partition(key).sort_values('Date', kind='stable')
+                        for bank, rows in df.groupby(df['Bank'].astype(object).fillna(''), sort=True):
+                            bank_dir = os.path.join(temp_dir, f'bank={bank}')
+                            os.makedirs(bank_dir, exist_ok=True)
+                            rows.to_parquet(os.path.join(bank_dir, 'part.parquet'), index=False)
+                        state[key] = signature
+                    else:
+                        state.pop(key, None)
+
+                    # Swap the month directory in one step
+                    shutil.rmtree(month_dir, ignore_errors=True)
+                    if os.listdir(temp_dir):
+                        os.replace(temp_dir, month_dir)
+                finally:
+                    shutil.rmtree(temp_dir, ignore_errors=True)
+
+            self._write_state(state)
+
+    # Months whose CSV changed (or appeared/disappeared) since they were last mirrored
+    def stale_partitions(self):
+        state = self._read_state()
+        current = set(self.store.partitions())
+        stale = [key for key in current if state.get(key) != self._signature(key)]
+        return sorted(stale + [key for key in state if key not in current])
+
+    def sync_stale(self):
+        stale = self.stale_partitions()
+        if stale:
+            self.sync(stale)
+        return stale
+
+    ### READING
+
+    # Load selected columns of selected months/banks, memory-mapping the Parquet files
+    def read(self, columns=None, years=None, months=None, banks=None):
+        filters = []
+        if years is not None:
+            filters.append(('year', 'in', list(years)))
+        if months is not None:
+            filters.append(('month', 'in', list(months)))
+        if banks is not None:
+            filters.append(('bank', 'in', list(banks)))
+
+        if not os.path.isdir(self.mirror_dir):
+            return pd.DataFrame(columns=columns)
+
+        df = pd.read_parquet(self.mirror_dir, engine='pyarrow', columns=columns, filters=filters or None, memory_map=True)
+        return df.drop(columns=[field for field in PARTITION_FIELDS if field in df.columns and (columns is None or field not in columns)])
+
+
+# Keep the Parquet mirror of a ledger current for the given months, if pyarrow is installed
+def sync_parquet_mirror(ledger_dir, keys):
+    if not HAS_PYARROW or not keys:
+        return
+    try:
+        ParquetMirror(ledger_dir).sync(keys)
+    except Exception as e:
+        print(f"An error occurred while updating the Parquet mirror: {str(e)}")
+
+
+def read_ledger_parquet(ledger_dir, columns=None, years=None, months=None, banks=None, refresh=True):
+    mirror = ParquetMirror(ledger_dir)
+    if refresh:
+        mirror.sync_stale()
+    return mirror.read(columns, years, months, banks)
@@ -1,375 +1,305 @@
 import os
-import shutil
-import time
-from datetime import date, datetime
-import hashlib
 import json
 import re
-import tabula
+import uuid
 
 import pandas as pd
-from currency_converter import CurrencyConverter, ECB_URL
 
-# Create a single instance of CurrencyConverter
-c = CurrencyConverter(ECB_URL, fallback_on_wrong_date=True, fallback_on_missing_rate=True)
+from backup_store import KEEP_LAST, BackupStore
+from bank_formats import get_bank_format, hashed_unique_ids, normalize_statement, read_csv_statement, read_xlsx_statement
+from category_cache import CategoryCache
+from categorizer import UNCATEGORIZED, RuleTrie, diff_rules, effective_rules, rules_fingerprint
+from currency import RateStore
+from dedup_index import DedupIndex
+from excel_export import export_monthly_workbooks
+from ledger import LedgerStore
+from ledger_parquet import sync_parquet_mirror
+from pdf_extract import read_pdf_tables
+from rollups import RollupStore
+from rule_analyzer import analyze_rules, print_rule_analysis
+from run_report import count, finish_run, report_path, stage, start_run
+from transaction_batch import TransactionBatch
+from transfers import match_ledger_transfers
+from unique_ids import detect_id_scheme
+
+# Create a single rate store. It is only opened the first time a non-DKK amount is converted,
+# and set AUTOBANKING_OFFLINE=1 to convert from the cached rates without network access
+c = RateStore()
 
 ### UTILITY FUNCTIONS
 
-# Define a function to calculate the exchange rate
-def calculate_target_currency_rate(row, c):
+def backup_ledger(ledger_dir, keep_last=KEEP_LAST):
     try:
-        specified_date = row['Date']
-        extract_date = datetime.strptime(specified_date, '%d-%m-%Y')
-        this_date = date(extract_date.year, extract_date.month, extract_date.day)
-        base_currency = row['Currency']  # Replace 'Currency' with the actual column name for currency
-        target_currency = "DKK"  # You specified DKK as the target currency
-        amount = row['Amount_currency']  # Replace 'Amount_Currency' with the actual column name for the amount in currency
-
-        # Perform the currency conversion with error handling
-        converted_amount = c.convert(amount, base_currency, target_currency, this_date)
-
-        return round(converted_amount, 2)
-
-    except Exception as e:
-        return None  # Handle errors by returning None or any suitable value
-
-def get_currency_rate(row, c):
-    try:
-        specified_date = row['Date']
-        extract_date = datetime.strptime(specified_date, '%d-%m-%Y')
-        this_date = date(extract_date.year, extract_date.month, extract_date.day)
-        base_currency = row['Currency']  # Replace 'Currency' with the actual column name for currency
-        target_currency = "DKK"  # You specified DKK as the target currency
-
-        # Perform the currency conversion with error handling
-        currency_rate = c.convert(1.00, base_currency, target_currency, this_date)
-
-        return round(currency_rate, 2)
-
-    except Exception as e:
-        return None  # Handle errors by returning None or any suitable value
-
-def is_file_open(file_path):
-    try: 
-        if os.path.isfile(file_path):
-            os.rename(file_path, file_path)
-        return False
-    except OSError:
-        return True
-
-def backup_csv_file(csv_file_path):
-    try:
-        # Check if the CSV file exists
-        if not os.path.isfile(csv_file_path):
-            print(f"CSV file '{csv_file_path}' does not exist. Skipping backup.")
-            return
-
-        # Check if the CSV file is empty
-        if os.path.getsize(csv_file_path) == 0:
-            print(f"CSV file '{csv_file_path}' is empty. Skipping backup.")
-            return
-
-        # Create a backup file name by adding a timestamp to the original file name
-        backup_file_path = csv_file_path.replace('.csv', f'_backup_{time.strftime("%Y%m%d%H%M%S")}.csv')
-
-        # Copy the original CSV file to the backup location
-        shutil.copyfile(csv_file_path, backup_file_path)
-
-        print(f"Backup created: {backup_file_path}")
+        with stage('backup', ledger=ledger_dir) as info:
+            # Check if the ledger has any partitions
+            if not os.path.isdir(ledger_dir) or LedgerStore(ledger_dir).is_empty():
+                print(f"Ledger '{ledger_dir}' is empty. Skipping backup.")
+                info['skipped'] = True
+                return
+
+            # Snapshot into <ledger>_backups; only files changed since the last snapshot are stored
+            backups = BackupStore(ledger_dir)
+            info['snapshot'] = backups.snapshot()
+
+            # Drop old snapshots and the file versions only they referred to
+            backups.prune(keep_last)
+
+        if info['snapshot'] is None:
+            print("Ledger unchanged since the last backup.")
     except Exception as e:
         print(f"An error occurred while creating a backup: {str(e)}")
 
 ### DATA EXTRACTION FUNCTIONS
 
-def extract_csv_data(file_path, bank):
+def extract_csv_data(file_path, bank, id_scheme=None, strict=False):
     try:
         print(f"Extracting data from CSV file: {file_path}")
-        # Specific settings for Danske Bank
-        if bank == 'Danske Bank':
-            delimiter = ';'
-            encoding = 'ISO-8859-1'
-
-            # Read the CSV file into a pandas DataFrame with Danske Bank-specific settings
-            df = pd.read_csv(file_path, delimiter=delimiter, encoding=encoding)
-
-            # Rename columns for consistency and readability for Danske Bank
-            df = df.rename(columns={'Dato': 'Date', 'Tekst': 'Description', 'Beløb': 'Amount'})
-
-            # Format the 'Date' column to 'DD-MM-YYYY' format for Danske Bank
-            df['Date'] = pd.to_datetime(df['Date'], format='%d.%m.%Y').dt.strftime('%d-%m-%Y')
-
-            # Remove thousand separator (dot) and replace comma with dot for decimal delimiter in 'Amount' column for Danske Bank
-            df['Amount'] = df['Amount'].str.replace('.', '').str.replace(',', '.', regex=False).astype(float)
-
-            # Create unique identifier
-            df['UniqueID'] = df.apply(lambda row: hashlib.md5(f"{row['Date']}_{row['Description']}_{row['Amount']}_{row['Saldo']}".encode()).hexdigest(), axis=1)
-
-            # Create bank identifier
-            df['Bank'] = 'Danske Bank'
-            df['Amount_currency'] = df['Amount']
-            df['Currency'] = 'DKK'
-            df['Currency_Rate'] = 1
-
-            selected_columns = ['Date', 'Description', 'Amount', 'Amount_currency', 'Currency', 'Currency_Rate', 'Bank', 'UniqueID']
-            df_selected = df[selected_columns]
-
-        elif bank == 'Wise':
-            # Specific settings for Wise bank (add more banks as needed)
-            delimiter = ','  # Change this delimiter as per the CSV format
-            encoding = 'utf-8'  # Change encoding if necessary
-
-            # Read the CSV file into a pandas DataFrame with settings for Wise bank
-            df = pd.read_csv(file_path, delimiter=delimiter, encoding=encoding)
-
-            # Filter out unwanted rows
-            df = df[(df['Status'] != 'CANCELLED') & (df['Target amount (after fees)'] != 0) & (df['Source amount (after fees)'] != 0)]
-
-            # Format the date column to 'DD-MM-YYYY' format
-            df['Date'] = pd.to_datetime(df['Finished on'], format='%Y-%m-%d %H:%M:%S').dt.strftime('%d-%m-%Y')
-
-            # Initialize empty columns
-            df['Description'] = ''
-            df['Amount_currency'] = ''
-            df['Currency'] = ''
-
-            # Set values based on 'Direction' column
-            df.loc[df['Direction'] == 'IN', 'Description'] = df['Source name']
-            df.loc[df['Direction'] == 'OUT', 'Description'] = df['Target name']
-            df.loc[df['Direction'] == 'NEUTRAL', 'Description'] = 'Internal transfer'
-
-            df.loc[df['Direction'] == 'IN', 'Amount_currency'] = df['Source amount (after fees)']
-            df.loc[df['Direction'] == 'OUT', 'Amount_currency'] = df['Target amount (after fees)'] * -1
-            df.loc[df['Direction'] == 'NEUTRAL', 'Amount_currency'] = 0
-
-            df.loc[df['Direction'] == 'IN', 'Currency'] = df['Source currency']
-            df.loc[df['Direction'] == 'OUT', 'Currency'] = df['Target currency']
-            df.loc[df['Direction'] == 'NEUTRAL', 'Currency'] = df['Target currency']
-
-            # Create unique identifier
-            df['UniqueID'] = df['ID']
-
-            # Create bank identifier
-            df['Bank'] = 'Wise'
-
-            #create DKK_rate
-            df['Amount'] = df.apply(calculate_target_currency_rate, axis=1, c=c)
-            print(df['Amount'])
-            df['Currency_Rate'] = df.apply(get_currency_rate, axis=1, c=c)
-
-            selected_columns = ['Date', 'Description', 'Amount', 'Amount_currency', 'Currency', 'Currency_Rate', 'Bank', 'UniqueID']
-            df_selected = df[selected_columns]
-
-        elif bank == 'Lunar':
-            delimiter = ','  # Change this delimiter as per the CSV format
-            encoding = 'utf-8'  # Change encoding if necessary
-
-            df = pd.read_csv(file_path, delimiter=delimiter, encoding=encoding)
-
-            df = df.rename(columns={'Dato': 'Date', 'Tekst': 'Description', 'Beløb': 'Amount', 'Valuta': 'Currency'})
-            df['Date'] = pd.to_datetime(df['Date'], format='%Y-%m-%d').dt.strftime('%d-%m-%Y')
-
-            # Remove thousand separator (dot) and replace comma with dot for decimal delimiter in 'Amount' column for Danske Bank
-            df['Amount'] = df['Amount'].str.replace('.', '').str.replace(',', '.', regex=False).astype(float)
-
-            # Create unique identifier
-            df['UniqueID'] = df.apply(lambda row: hashlib.md5(f"{row['Date']}_{row['Description']}_{row['Amount']}_{row['Saldo']}".encode()).hexdigest(), axis=1)
-
-            # Create bank identifier
-            df['Bank'] = 'Lunar'
-            df['Amount_currency'] = df['Amount']
-            df['Currency_Rate'] = 1
-
-            selected_columns = ['Date', 'Description', 'Amount', 'Amount_currency', 'Currency', 'Currency_Rate', 'Bank', 'UniqueID']
-            df_selected = df[selected_columns]
-
-        elif bank == 'Skrill':
-            delimiter = ','
-            encoding = 'utf-8'
-
-            df = pd.read_csv(file_path, delimiter=delimiter, encoding=encoding)
-
-            df = df.rename(columns={'ID': 'UniqueID', 'Time (CET)': 'Date', 'Transaction Details': 'Description', 'Transaction Currency': 'Currency'})
-            df['Date'] = pd.to_datetime(df['Date'], format='%d %b %y %H:%M').dt.strftime('%d-%m-%Y')
-
-            # Convert columns to numeric and replace non-numeric values with NaN
-            df['[-]'] = pd.to_numeric(df['[-]'], errors='coerce')
-            df['[+]'] = pd.to_numeric(df['[+]'], errors='coerce')
+        with stage('extract', bank=bank, file=file_path) as info:
+            # Bank specific settings come from the format registry
+            bank_format = get_bank_format(bank, 'csv')
 
-            df['Amount'] = 0 - df['[-]'].fillna(0) + df['[+]'].fillna(0)
+            # Read only the needed columns, straight into their final types
+            df = read_csv_statement(file_path, bank_format)
+            info['rows_in'] = len(df)
 
-            df['Bank'] = 'Skrill'
-            df['Amount_currency'] = df['Amount']
-            df['Currency_Rate'] = 1
+            # Rename, format and add the common columns
+            df_selected = normalize_statement(df, bank, bank_format, converter=c, id_scheme=id_scheme)
 
-            selected_columns = ['Date', 'Description', 'Amount', 'Amount_currency', 'Currency', 'Currency_Rate', 'Bank', 'UniqueID']
-            df_selected = df[selected_columns]
-
-
-        else:
-            raise ValueError("Unsupported bank")
-
-        # Convert the DataFrame to a list of dictionaries
-        print("Data extraction complete.")
-        transactions = df_selected.to_dict(orient='records')
+            # Convert the DataFrame to a columnar transaction batch
+            print("Data extraction complete.")
+            transactions = TransactionBatch.from_pandas(df_selected)
+            info['rows_out'] = len(transactions)
+        count('rows_extracted', len(transactions))
 
     except FileNotFoundError:
+        # In strict mode the caller reports the error itself
+        if strict:
+            raise
         print(f"File not found: {file_path}")
-        transactions = []
+        transactions = TransactionBatch.empty()
     except Exception as e:
+        if strict:
+            raise
         print(f"An error occurred: {str(e)}")
-        transactions = []
+        transactions = TransactionBatch.empty()
 
     return transactions
 
-def extract_pdf_data(file_path, bank):
-    try:          
-        if bank == 'Forbrugsforeningen':
-            pdf_file = file_path
-            dfs = tabula.read_pdf(pdf_file, pages='all', multiple_tables=True, encoding='utf-8')
-            
-            # Initialize an empty DataFrame
-            extracted_df = pd.DataFrame()
-            
-            # Iterate through the list of DataFrames and concatenate them
-            for df in dfs:
-                if 'Dato' in df.columns:
-                    # Concatenate the DataFrame to the existing extracted_df
-                    extracted_df = pd.concat([extracted_df, df], ignore_index=True)
-            
+def extract_pdf_data(file_path, bank, id_scheme=None, strict=False):
+    try:
+        with stage('extract', bank=bank, file=file_path) as info:
+            bank_format = get_bank_format(bank, 'pdf')
+
+            # Parse (or load from the cache) the transaction tables, concatenated once
+            extracted_df = read_pdf_tables(file_path, bank_format['table_column'])
+            info['rows_in'] = len(extracted_df)
+
             # Manipulate on pd.df
-            extracted_df = extracted_df.rename(columns={'Dato': 'Date', 'Posteringstekst': 'Description', 'Beløb': 'Amount', 'Valuta': 'Currency'})
-            extracted_df['Date'] = pd.to_datetime(extracted_df['Date'], format='%d/%m/%Y').dt.strftime('%d-%m-%Y')
-            extracted_df['Amount'] = extracted_df['Amount'].str.replace('.', '').str.replace(',', '.', regex=False).astype(float)
-            print(extracted_df['Amount'])
-            extracted_df['UniqueID'] = extracted_df.apply(lambda row: hashlib.md5(f"{row['Date']}_{row['Description']}_{row['Amount']}".encode()).hexdigest(), axis=1)
-            # Create bank identifier
-            extracted_df['Bank'] = 'Forbrugsforeningen'
-            extracted_df['Amount_currency'] = extracted_df['Amount']
-            extracted_df['Currency_Rate'] = 1
-            
-            selected_columns = ['Date', 'Description', 'Amount', 'Amount_currency', 'Currency', 'Currency_Rate', 'Bank', 'UniqueID']
-            df_selected = extracted_df[selected_columns]
-
-        elif bank == 'Other bank':
-            pass
-        else:
-            raise ValueError("Unsupported bank")
+            df_selected = normalize_statement(extracted_df, bank, bank_format, converter=c, id_scheme=id_scheme)
+            print(df_selected['Amount'])
 
-        # Convert the DataFrame to a list of dictionaries
-        transactions = df_selected.to_dict(orient='records')
-        return transactions
+            # Convert the DataFrame to a columnar transaction batch
+            transactions = TransactionBatch.from_pandas(df_selected)
+            info['rows_out'] = len(transactions)
+        count('rows_extracted', len(transactions))
 
     except FileNotFoundError:
+        # In strict mode the caller reports the error itself
+        if strict:
+            raise
         print(f"File not found: {file_path}")
-        transactions = []
+        transactions = TransactionBatch.empty()
     except Exception as e:
+        if strict:
+            raise
         print(f"An error occurred: {str(e)}")
-        transactions = []
+        transactions = TransactionBatch.empty()
 
-    return 
+    return transactions
 
-def extract_xlsx_data(file_path, bank):
+def extract_xlsx_data(file_path, bank, id_scheme=None, strict=False):
     try:
-        if bank == 'Norwegian':
-            # Specific settings for Bank Norwegian
-            # Modify this section as per Bank Norwegian's format
-            
-            # Read the XLSX file into a pandas DataFrame with specific settings
-            df = pd.read_excel(file_path)
-            
-            # Rename columns for consistency and readability
-            df = df.rename(columns={'TransactionDate': 'Date', 'Text': 'Description',
-                                    'Amount': 'Amount', 'Type': 'Type', 'Currency Amount': 'Amount_currency', 
-                                    'Currency Rate': 'Currency_Rate'})
-
-            # Data manipulation and formatting as needed for Bank Norwegian's XLSX format
-            # You can add specific data manipulation steps here
-
-            # Format the date column to 'DD-MM-YYYY' format
-            df['Date'] = pd.to_datetime(df['Date'], format='%d.%m.%Y').dt.strftime('%d-%m-%Y')
-
-            # Create unique identifier
-            df['UniqueID'] = df.apply(lambda row: hashlib.md5(f"{row['Date']}_{row['Description']}_{row['Amount']}".encode()).hexdigest(), axis=1)
-
-            # Create bank identifier
-            df['Bank'] = 'Norwegian'
-
-            selected_columns = ['Date', 'Description', 'Amount', 'Type', 'Amount_currency', 'Currency', 'Currency_Rate', 'UniqueID', 'Bank']
-            df_selected = df[selected_columns]
-            df_selected = df_selected[df_selected['Type'] != "Reserveret"]
-            df_selected = df_selected[df_selected['Type'] != "Indbetaling"]
-            df_selected = df_selected.drop('Type', axis=1)
-
-        elif bank == 'Other Bank':
-            # Specific settings for another bank (add more banks as needed)
-            # Modify this section as per the other bank's format
-            pass
-        else:
-            raise ValueError("Unsupported bank")
+        with stage('extract', bank=bank, file=file_path) as info:
+            bank_format = get_bank_format(bank, 'xlsx')
+
+            # Read the XLSX file into a pandas DataFrame with only the needed columns
+            df = read_xlsx_statement(file_path, bank_format)
+            info['rows_in'] = len(df)
+
+            df_selected = normalize_statement(df, bank, bank_format, converter=c, id_scheme=id_scheme)
 
-        # Convert the DataFrame to a list of dictionaries
-        transactions = df_selected.to_dict(orient='records')
+            # Convert the DataFrame to a columnar transaction batch
+            transactions = TransactionBatch.from_pandas(df_selected)
+            info['rows_out'] = len(transactions)
+        count('rows_extracted', len(transactions))
 
     except FileNotFoundError:
+        # In strict mode the caller reports the error itself
+        if strict:
+            raise
         print(f"File not found: {file_path}")
-        transactions = []
+        transactions = TransactionBatch.empty()
     except Exception as e:
+        if strict:
+            raise
         print(f"An error occurred: {str(e)}")
-        transactions = []
+        transactions = TransactionBatch.empty()
 
     return transactions
 
+# Extract data from a statement file based on its format
+def extract_statement(file_path, bank, id_scheme=None, strict=False):
+    if file_path.endswith('.csv'):
+        return extract_csv_data(file_path, bank, id_scheme, strict)
+    elif file_path.endswith('.pdf'):
+        return extract_pdf_data(file_path, bank, id_scheme, strict)
+    elif file_path.endswith('.xlsx'):
+        return extract_xlsx_data(file_path, bank, id_scheme, strict)
+    else:
+        raise ValueError("Unsupported file format")
+
+
+### STREAMING IMPORT
+
+# Rows per batch when streaming a statement through the pipeline
+STREAM_BATCH_SIZE = 50000
+
+# Yield a statement as TransactionBatches of at most batch_size rows.
+# CSV files are read chunk by chunk; XLSX and PDF statements are read whole and then split.
+def iter_statement_batches(file_path, bank, batch_size=STREAM_BATCH_SIZE, id_scheme=None):
+    if file_path.endswith('.csv'):
+        bank_format = get_bank_format(bank, 'csv')
+        chunks = read_csv_statement(file_path, bank_format, chunksize=batch_size)
+    elif file_path.endswith('.pdf'):
+        bank_format = get_bank_format(bank, 'pdf')
+        chunks = [read_pdf_tables(file_path, bank_format['table_column'])]
+    elif file_path.endswith('.xlsx'):
+        bank_format = get_bank_format(bank, 'xlsx')
+        chunks = [read_xlsx_statement(file_path, bank_format)]
+    else:
+        raise ValueError("Unsupported file format")
+
+    for chunk in chunks:
+        batch = TransactionBatch.from_pandas(normalize_statement(chunk, bank, bank_format, converter=c, id_scheme=id_scheme))
+        for start in range(0, len(batch), batch_size):
+            yield batch.slice(start, start + batch_size)
+
+# Extract -> categorize -> dedup -> export one batch at a time, so peak memory depends on
+# batch_size rather than on the size of the statement. Rows of earlier batches count as part
+# of the same statement for the dedup of later ones, so the result does not depend on where
+# the batches are cut. Returns {partition: rows appended}.
+def import_statement_stream(file_path, bank, ledger_dir, categorization_rules_path, batch_size=STREAM_BATCH_SIZE, id_scheme=None):
+    id_scheme = LedgerStore(ledger_dir).id_scheme(id_scheme)
+    rule_trie = RuleTrie(load_categorization_rules(categorization_rules_path))
+    category_cache = CategoryCache(ledger_dir)
+
+    # Update existing
+    update_existing_category(ledger_dir, categorization_rules_path, category_cache)
+
+    # The rows of this stream are marked in the UniqueID index rather than kept in memory
+    appended = {}
+    dedup_index = DedupIndex(ledger_dir, keep_open=True)
+    import_token = uuid.uuid4().hex
+    try:
+        for batch in iter_statement_batches(file_path, bank, batch_size, id_scheme):
+            batch_appended = process_and_export_data(categorize_transactions(batch, rule_trie, category_cache), ledger_dir, compact=False,
+                                                     dedup_index=dedup_index, import_token=import_token)
+            for key, rows in batch_appended.items():
+                appended[key] = appended.get(key, 0) + rows
+    finally:
+        dedup_index.end_import(import_token)
+        dedup_index.close()
+
+    # Sort every touched partition once, after the last batch, and mirror it to Parquet
+    LedgerStore(ledger_dir).compact(list(appended))
+    sync_parquet_mirror(ledger_dir, list(appended))
+    print(f"Streamed {sum(appended.values())} new rows from {file_path} into {ledger_dir}")
+    return appended
+
 
 ### DATA TRANSFORMATION FUNCTIONS
 
-def process_and_export_data(transactions, output_file_path):
+# import_token is shared by the batches of one streamed statement: the IDs appended are
+# recorded with it, and later batches treat them as rows of the same statement instead of
+# as history.
+# strict=True raises errors instead of printing them and returning {}, for callers that must
+# know whether the rows reached the ledger.
+def process_and_export_data(transactions, ledger_dir, compact=True, dedup_index=None, import_token=None, strict=False):
     try:
-        if os.path.isfile(output_file_path):
-            # Load the existing CSV file
-            existing_data = pd.read_csv(output_file_path, encoding='utf-8', sep=';', decimal=',')
+        store = LedgerStore(ledger_dir)
+
+        # Create a DataFrame from the new transactions (a TransactionBatch, DataFrame or list of dicts)
+        new_data = TransactionBatch.coerce(transactions).to_pandas()
+
+        if new_data.empty:
+            print("No new transactions to export.")
+            return {}
+
+        # Convert 'UniqueID' column to strings
+        new_data['UniqueID'] = new_data['UniqueID'].astype(str)
 
-            # Create a DataFrame from the new transactions
-            new_data = pd.DataFrame(transactions)
+        # IDs of another scheme than the ledger's would never match its history; this raises.
+        # Only the IDs we hashed show the scheme, not the ones banks supply.
+        store.id_scheme(detect_id_scheme(hashed_unique_ids(new_data)))
 
-            # Convert 'UniqueID' columns to strings in both DataFrames
-            new_data['UniqueID'] = new_data['UniqueID'].astype(str)
-            existing_data['UniqueID'] = existing_data['UniqueID'].astype(str)
+        with stage('dedup') as info:
+            info['rows_in'] = len(new_data)
 
-            # Check for duplicates based on the 'UniqueID' column
-            duplicates = new_data[new_data['UniqueID'].isin(existing_data['UniqueID'])]
+            # Check for duplicates against the persistent UniqueID index instead of loading the ledger
+            dedup_index = dedup_index if dedup_index is not None else DedupIndex(ledger_dir)
+            in_batch, in_history = dedup_index.find_duplicates(new_data['UniqueID'], import_token)
 
-            if not duplicates.empty:
+            if in_batch.any():
+                # Identical rows inside one statement can be genuine repeats (e.g. two equal purchases
+                # on the same day without a balance column), so they are reported but kept
+                print(f"Warning: {int(in_batch.sum())} rows in the new data share a UniqueID with another new row.")
+
+            if in_history.any():
                 # Remove duplicates from the new_data DataFrame
-                new_data = new_data[~new_data['UniqueID'].isin(existing_data['UniqueID'])]
+                new_data = new_data[~in_history]
 
-                print(f"Removed {len(duplicates)} duplicate rows from new data.")
+                print(f"Removed {int(in_history.sum())} duplicate rows from new data.")
 
-            # Concatenate the existing data and new data
-            combined_data = pd.concat([existing_data, new_data], ignore_index=True)
+            info['duplicates_in_batch'] = int(in_batch.sum())
+            info['duplicates_dropped'] = int(in_history.sum())
+            info['rows_out'] = len(new_data)
+        count('duplicates_dropped', int(in_history.sum()))
 
-            # Write the combined data to the same CSV file
-            combined_data.to_csv(output_file_path, index=False, sep=";", decimal=",")
+        with stage('export') as info:
+            # Append the new rows to their month partitions and record their IDs
+            existing, versions_before = set(store.partitions()), store.versions()
+            appended = store.append(new_data)
+            dedup_index.add(new_data['UniqueID'], new_data['Date'], import_token)
+            info['rows_out'] = len(new_data)
+            info['partitions'] = len(appended)
+        count('rows_appended', len(new_data))
+        print(f"Data appended to {len(appended)} partition(s) in {ledger_dir}: {appended}")
 
-            print(f"Data appended to {output_file_path}")
-        else:
-            print(f"Creating a new CSV file: {output_file_path}")
-            # If the file doesn't exist, create a new one
-            df = pd.DataFrame(transactions)
-            df.to_csv(output_file_path, index=False, encoding='utf-8', sep=";", decimal=",")
+        # Add the new rows to the monthly totals
+        old_versions = {key: versions_before.get(key, 0) if key in existing else None for key in appended}
+        RollupStore(ledger_dir).apply(old_versions, store.versions(), added=new_data)
+
+        # Sort the touched partitions without holding up the rest of the run, then refresh
+        # their Parquet mirror from the sorted files
+        if compact:
+            store.compact_in_background(list(appended), on_done=lambda _: sync_parquet_mirror(ledger_dir, list(appended)))
 
-            print(f"Data exported to a new file: {output_file_path}")
+        return appended
 
     except Exception as e:
+        # In strict mode the caller reports the error itself
+        if strict:
+            raise
         print(f"An error occurred in process_and_export_data: {str(e)}")
+        return {}
 
 ### CATEGORIZATION FUNCTIONS
 
 # Function to search for a category using the new description in categorization_rules.json
 def search_category_by_description(new_description, categorization_rules):
-    for rule in categorization_rules:
-        if rule['keyword'].lower() in new_description.lower():
-            return rule['category']
-    return None
+    rule_trie = RuleTrie(categorization_rules, keyword_field='keyword', value_fields=('category',))
+    rule = rule_trie.lookup(new_description, mode='substring')
+    return None if rule is None else rule['category']
 
 # Function to load categorization rules from a JSON file
 def load_categorization_rules(file_path):
@@ -400,61 +330,140 @@ def append_categorization_rules(file_path, new_rules):
         print(f"An error occurred: {str(e)}")
 
 
-def categorize_transactions(transactions, rules):
-    categorized_transactions = []
-
-    for transaction in transactions:
-        categorized_transaction = transaction.copy()  # Create a copy of the original transaction
-
-        # Iterate through the rules to find a match
-        for rule in rules:
-            keyword = rule['Keyword']
-            main_category = rule['Main Category']
-            sub_category = rule['Sub Category']
-
-            # Check if the description starts with the keyword
-            if transaction['Description'].lower().startswith(keyword.lower()):
-                categorized_transaction['Main Category'] = main_category
-                categorized_transaction['Sub Category'] = sub_category
-                break  # Break the loop if a match is found
-
-        # If no match is found, assign default categories
-        if 'Main Category' not in categorized_transaction:
-            categorized_transaction['Main Category'] = 'Uncategorized'
-        if 'Sub Category' not in categorized_transaction:
-            categorized_transaction['Sub Category'] = 'Uncategorized'
-
-        # Append the categorized transaction to the list
-        categorized_transactions.append(categorized_transaction)
-
-    return categorized_transactions
-
-def update_existing_category(output_csv_path, categorization_rules_path):
+# Categorize a TransactionBatch (or a list of transaction dicts) and return a new batch with
+# the 'Main Category', 'Sub Category' and 'Rule' columns. rules may be a rule list or a
+# compiled RuleTrie. With a CategoryCache, descriptions seen before are not matched again.
+def categorize_transactions(transactions, rules, cache=None):
+    batch = TransactionBatch.coerce(transactions)
+
+    with stage('categorize') as info:
+        # Compile the rules once and categorize all descriptions in a single batched call
+        rule_trie = rules if isinstance(rules, RuleTrie) else RuleTrie(rules)
+        hits, misses = (cache.hits, cache.misses) if cache is not None else (0, 0)
+        categories = rule_trie.categorize(pd.Series(batch['Description'], dtype=object), rule_column='Rule', cache=cache)
+
+        uncategorized = int((categories['Main Category'] == UNCATEGORIZED).sum())
+        info.update(rows_in=len(batch), rules=len(rule_trie.rules), uncategorized=uncategorized)
+        if cache is not None:
+            cache.save()
+            _record_cache_use(info, cache, hits, misses)
+    count('uncategorized', uncategorized)
+
+    # 'Rule' remembers which keyword matched, for incremental updates
+    return batch.with_columns(**{
+        'Main Category': pd.Categorical(categories['Main Category']),
+        'Sub Category': pd.Categorical(categories['Sub Category']),
+        'Rule': categories['Rule'].to_numpy(),
+    })
+
+# The rule set the ledger was last categorized with is kept next to the partitions
+RULES_STATE_FILE = '_rules_state.json'
+
+def load_rules_state(ledger_dir):
     try:
-        # Load categorization rules from the JSON file
-        with open(categorization_rules_path, 'r') as json_file:
-            categorization_rules = json.load(json_file)
-
-        # Load existing data from the output CSV file
-        existing_data = pd.read_csv(output_csv_path, encoding='utf-8', sep=';', decimal=',')
-
-        # Create a dictionary of categorization rules for faster lookup
-        categorization_dict = {rule['Keyword'].lower(): rule for rule in categorization_rules}
-
-        # Define a function to categorize descriptions using the same logic as the first function
-        def categorize_description(desc):
-            for keyword, rule in categorization_dict.items():
-                if desc.lower().startswith(keyword.lower()):
-                    return rule['Main Category'], rule['Sub Category']
-            return 'Uncategorized', 'Uncategorized'
-
-        # Apply the categorize_description function to the 'Description' column
-        existing_data[['Main Category', 'Sub Category']] = existing_data['Description'].apply(categorize_description).apply(pd.Series)
-
-        # Save the updated data back to the output CSV file
-        existing_data.to_csv(output_csv_path, index=False, sep=";", decimal=",", encoding='utf-8')
-
-        print(f"Categories updated in {output_csv_path}")
+        with open(os.path.join(ledger_dir, RULES_STATE_FILE), 'r') as json_file:
+            return json.load(json_file)
+    except FileNotFoundError:
+        return None
+
+def save_rules_state(ledger_dir, categorization_rules):
+    state = {'fingerprint': rules_fingerprint(categorization_rules), 'rules': effective_rules(categorization_rules)}
+    state_path = os.path.join(ledger_dir, RULES_STATE_FILE)
+    with open(state_path + '.tmp', 'w') as json_file:
+        json.dump(state, json_file, indent=4)
+    os.replace(state_path + '.tmp', state_path)
+    return state
+
+# Record how many description lookups a stage answered from the category cache
+def _record_cache_use(info, cache, hits_before, misses_before):
+    info['cache_hits'] = cache.hits - hits_before
+    info['cache_misses'] = cache.misses - misses_before
+    count('category_cache_hits', info['cache_hits'])
+    count('category_cache_misses', info['cache_misses'])
+
+# A caller that keeps the rules compiled (the daemon) passes its rule_trie, and the rules
+# state this returned last time, instead of having both read from disk again. Returns the
+# rules state the ledger is categorized with (None after an error).
+def update_existing_category(ledger_dir, categorization_rules_path, cache=None, rule_trie=None, rules_state=None):
+    try:
+        with stage('recategorize') as info:
+            # Load categorization rules from the JSON file
+            if rule_trie is None:
+                with open(categorization_rules_path, 'r') as json_file:
+                    categorization_rules = json.load(json_file)
+            else:
+                categorization_rules = rule_trie.rules
+
+            store = LedgerStore(ledger_dir)
+            state = rules_state if rules_state is not None else load_rules_state(ledger_dir)
+
+            # Nothing to do if the rules are the same as last time
+            if state is not None and state['fingerprint'] == rules_fingerprint(categorization_rules):
+                print("Categorization rules unchanged. Skipping category update.")
+                info['skipped'] = True
+                return state
+
+            # Compile the rules into a prefix trie once for all partitions
+            rule_trie = rule_trie if rule_trie is not None else RuleTrie(categorization_rules)
+            cache = cache if cache is not None else CategoryCache(ledger_dir)
+            hits, misses = cache.hits, cache.misses
+
+            # Work out which rows can be affected by the rule changes. Rows matched by a removed or
+            # edited keyword must be re-evaluated, and so must rows that an added keyword matches.
+            # A change in the order of existing keywords can move any row, so it triggers a full pass.
+            diff = None if state is None else diff_rules(state['rules'], effective_rules(categorization_rules))
+            full_pass = diff is None or diff['reordered']
+            if not full_pass:
+                stale_keywords = set(diff['removed']) | set(diff['edited'])
+                added_trie = RuleTrie([{'Keyword': keyword} for keyword in diff['added']])
+                print(f"Rule changes: {len(diff['added'])} added, {len(diff['removed'])} removed, {len(diff['edited'])} edited")
+
+            updated = []
+            versions_before = store.versions()
+            removed_rows, added_rows = [], []
+            info.update(full_pass=full_pass, partitions_scanned=0, rows_reevaluated=0)
+
+            for key in store.partitions():
+                existing_data = store.read_partition(key)
+                info['partitions_scanned'] += 1
+
+                if full_pass or 'Rule' not in existing_data.columns:
+                    affected = pd.Series(True, index=existing_data.index)
+                else:
+                    matched_keywords = existing_data['Rule'].astype(object).fillna('')
+                    affected = matched_keywords.isin(stale_keywords) | added_trie.matches(existing_data['Description'])
+
+                if not affected.any():
+                    continue
+
+                categories = rule_trie.categorize(existing_data.loc[affected, 'Description'], rule_column='Rule', cache=cache)
+                info['rows_reevaluated'] += int(affected.sum())
+
+                # Only rewrite partitions where a category actually changed
+                current = existing_data.loc[affected].reindex(columns=categories.columns).astype(object).fillna('')
+                if current.equals(categories.astype(object)):
+                    continue
+
+                removed_rows.append(existing_data.loc[affected])
+                existing_data = existing_data.reindex(columns=list(dict.fromkeys(list(existing_data.columns) + list(categories.columns))))
+                existing_data[categories.columns] = existing_data[categories.columns].astype(object)
+                existing_data.loc[affected, categories.columns] = categories
+                existing_data[['Main Category', 'Sub Category']] = existing_data[['Main Category', 'Sub Category']].astype('category')
+                store.write_partition(key, existing_data)
+                updated.append(key)
+                added_rows.append(existing_data.loc[affected])
+
+            info['partitions_rewritten'] = len(updated)
+            if updated:
+                # Move the re-categorized rows to their new categories in the monthly totals
+                RollupStore(ledger_dir).apply({key: versions_before.get(key, 0) for key in updated}, store.versions(),
+                                              removed=pd.concat(removed_rows), added=pd.concat(added_rows))
+            cache.save()
+            _record_cache_use(info, cache, hits, misses)
+            sync_parquet_mirror(ledger_dir, updated)
+            state = save_rules_state(ledger_dir, categorization_rules)
+            print(f"Categories updated in {len(updated)} partition(s) of {ledger_dir}")
+            return state
 
     except Exception as e:
         print(f"An error occurred in update_existing_category: {str(e)}")
@@ -553,17 +562,25 @@ def find_redundant_keywords(json_file_path):
         return {}
 
 def main():
-    # Specify the output file path for the CSV file
+    # Specify the path of the old single-file ledger and the partitioned ledger that replaces it
     output_file_path = 'C:/Users/smrie/OneDrive/60-69 Finance/62 Personal Book/AutoRegner/GIT/output.csv'
+    ledger_dir = 'C:/Users/smrie/OneDrive/60-69 Finance/62 Personal Book/AutoRegner/GIT/ledger'
+
+    # Destination folder for the monthly Excel workbooks
+    excel_dir = 'C:/Users/smrie/OneDrive/60-69 Finance/62 Personal Book/AutoRegner/GIT/excel'
 
-    #Create backup
-    backup_csv_file(output_file_path)
+    # Every run writes a JSON report with per-stage timings and row counts here.
+    # Set profile_run / trace_memory to add cProfile hot spots and peak memory per stage.
+    report_dir = 'C:/Users/smrie/OneDrive/60-69 Finance/62 Personal Book/AutoRegner/GIT/run_reports'
+    profile_run = False
+    trace_memory = False
+    start_run(profile=profile_run, trace_memory=trace_memory)
 
-    #Check if the CSV file exists before proceeding
+    # Move an existing output.csv into month partitions the first time the ledger is used
+    LedgerStore(ledger_dir).import_legacy_csv(output_file_path)
 
-    while is_file_open(output_file_path):
-        print("please close the file")
-        input("Press any key to continue")
+    #Create backup (a snapshot that stores only the partitions changed since the last one)
+    backup_ledger(ledger_dir)
 
     try:
         # Specify the path to the statement file (CSV, PDF, or XML)
@@ -573,27 +590,38 @@ def main():
         # Specify the path to the categorization rules JSON file
         categorization_rules_path = 'categorization_rules.json'  # Replace with your actual path
 
-        # Extract data from the statement file based on its format
-        if file_path.endswith('.csv'):
-            transactions = extract_csv_data(file_path, bank)
-        elif file_path.endswith('.pdf'):
-            transactions = extract_pdf_data(file_path, bank)
-        elif file_path.endswith('.xlsx'):
-            transactions = extract_xlsx_data(file_path, bank)
+        # Set a batch size (e.g. STREAM_BATCH_SIZE) to stream very large statements in chunks
+        batch_size = None
+
+        # Build UniqueIDs with the scheme the ledger was created with
+        id_scheme = LedgerStore(ledger_dir).id_scheme()
+
+        if batch_size:
+            appended = import_statement_stream(file_path, bank, ledger_dir, categorization_rules_path, batch_size, id_scheme)
         else:
-            raise ValueError("Unsupported file format")
+            # Extract data from the statement file based on its format
+            transactions = extract_statement(file_path, bank, id_scheme)
+
+            # Load categorization rules from the JSON file
+            categorization_rules_list = load_categorization_rules(categorization_rules_path)
+
+            # Categorize transactions, remembering description matches across runs
+            category_cache = CategoryCache(ledger_dir)
+            pre_auto_categorize_transactions = categorize_transactions(transactions, categorization_rules_list, category_cache)
 
-        # Load categorization rules from the JSON file
-        categorization_rules_list = load_categorization_rules(categorization_rules_path)
+            # Update existing
+            update_existing_category(ledger_dir, categorization_rules_path, category_cache)
+            print("Category cache:", category_cache.stats())
 
-        # Categorize transactions
-        pre_auto_categorize_transactions = categorize_transactions(transactions, categorization_rules_list)
+            # Perform further data processing or export the data to Excel
+            appended = process_and_export_data(pre_auto_categorize_transactions, ledger_dir)
 
-        # Update existing
-        update_existing_category(output_file_path, categorization_rules_path)
+        # Pair withdrawals and deposits that move money between our own accounts, in the
+        # months that got new rows and their neighbours
+        match_ledger_transfers(ledger_dir, keys=list(appended))
 
-        # Perform further data processing or export the data to Excel
-        process_and_export_data(pre_auto_categorize_transactions, output_file_path)
+        # Rebuild the workbooks of the months that got new or re-categorized rows
+        export_monthly_workbooks(ledger_dir, excel_dir)
 
         #Post-processing of categories
         # Test the check_categories_and_duplicates function
@@ -602,9 +630,15 @@ def main():
         redundant = find_redundant_keywords('categorization_rules.json')
         print("Redundant keywords: ", redundant)
 
+        # Rules that can never match because an earlier keyword is a prefix of theirs; hit counts
+        # scan the whole ledger, so they are left to rule_analyzer.py
+        print_rule_analysis(analyze_rules(load_categorization_rules(categorization_rules_path)))
+
     except Exception as e:
         print(f"An error occurred in the main function: {str(e)}")    
 
+    finish_run(report_path(report_dir))
+
 
 if __name__ == "__main__":
 
@@ -0,0 +1,112 @@
+import hashlib
+import importlib.util
+import inspect
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+PDF_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.pdf_cache')
+
+# PDFs with more pages than this are split into ranges of this size and parsed in parallel
+PAGES_PER_TASK = 20
+
+# Bump when the parsing options change, so old cache entries are not reused
+CACHE_VERSION = 1
+
+HAS_PYPDF = importlib.util.find_spec('pypdf') is not None
+
+_pool = None
+
+
+### PARSING
+
+# tabula-py 2.8+ can run the JVM in-process through jpype. It is started on the first
+# call and then stays warm for every later call in the same process, instead of
+# starting a new java subprocess per read_pdf.
+def _read_pdf(file_path, pages):
+    import tabula
+
+    options = {'pages': pages, 'multiple_tables': True, 'encoding': 'utf-8'}
+    if 'force_subprocess' in inspect.signature(tabula.read_pdf).parameters:
+        options['force_subprocess'] = False
+    return tabula.read_pdf(file_path, **options)
+
+
+# Worker: parse one page range and keep only the transaction tables
+def _read_page_range(task):
+    file_path, pages, table_column = task
+    return [df for df in _read_pdf(file_path, pages) if table_column in df.columns]
+
+
+def count_pages(file_path):
+    if not HAS_PYPDF:
+        return None
+    from pypdf import PdfReader
+    return len(PdfReader(file_path).pages)
+
+
+def page_ranges(page_count, pages_per_task=PAGES_PER_TASK):
+    return [f'{start}-{min(start + pages_per_task - 1, page_count)}' for start in range(1, page_count + 1, pages_per_task)]
+
+
+# Worker processes are shared by all PDFs in a run, so each keeps its JVM warm
+def _get_pool(workers=None):
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=workers)
+    return _pool
+
+
+### CACHE
+
+def file_digest(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as pdf_file:
+        for block in iter(lambda: pdf_file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _cache_path(cache_dir, digest, table_column):
+    key = hashlib.sha256(f'{CACHE_VERSION}:{digest}:{table_column}'.encode()).hexdigest()
+    return os.path.join(cache_dir, f'{key}.pkl')
+
+
+### PUBLIC API
+
+# Column names of each table on the first page of a PDF, for telling statement formats apart
+def first_page_columns(file_path):
+    return [{str(column).strip() for column in df.columns} for df in _read_pdf(file_path, '1')]
+
+
+# Return all tables of a PDF statement that contain table_column, concatenated once.
+# Parsed tables are cached by the PDF's content hash, so an unchanged PDF is never
+# parsed twice. Large PDFs are split into page ranges parsed by worker processes.
+def read_pdf_tables(file_path, table_column, cache_dir=PDF_CACHE_DIR, workers=None):
+    digest = file_digest(file_path)
+    cache_path = _cache_path(cache_dir, digest, table_column) if cache_dir else None
+
+    if cache_path and os.path.isfile(cache_path):
+        print(f"Using cached tables for {file_path}")
+        return pd.read_pickle(cache_path)
+
+    page_count = count_pages(file_path)
+    if page_count is not None and page_count > PAGES_PER_TASK and workers != 1:
+        tasks = [(file_path, pages, table_column) for pages in page_ranges(page_count)]
+        tables = [df for chunk in _get_pool(workers).map(_read_page_range, tasks) for df in chunk]
+    else:
+        tables = _read_page_range((file_path, 'all', table_column))
+
+    if not tables:
+        raise ValueError(f"No tables with a '{table_column}' column found in {file_path}")
+
+    extracted_df = pd.concat(tables, ignore_index=True)
+
+    if cache_path:
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_path = cache_path + '.tmp'
+        extracted_df.to_pickle(temp_path)
+        os.replace(temp_path, cache_path)
+
+    return extracted_df
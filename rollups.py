@@ -0,0 +1,206 @@
+import argparse
+import os
+import sqlite3
+
+import pandas as pd
+
+from ledger import UNDATED_PARTITION, LedgerStore, partition_keys
+
+ROLLUP_FILE = '_rollups.sqlite'
+
+# Ledger columns a rollup row is keyed by (besides the month), and their SQL column names
+ROLLUP_KEYS = {'Bank': 'bank', 'Main Category': 'main_category', 'Sub Category': 'sub_category', 'Currency': 'currency'}
+
+# What summaries can be grouped by
+SUMMARY_GROUPS = {
+    'category': ['main_category', 'sub_category'],
+    'main_category': ['main_category'],
+    'bank': ['bank'],
+    'currency': ['currency'],
+    'all': ['bank', 'main_category', 'sub_category', 'currency'],
+}
+
+
+# Totals and counts of a set of ledger rows per (month, Bank, Main Category, Sub Category,
+# Currency); months are partition keys
+def aggregate_rows(df):
+    if df.empty:
+        return pd.DataFrame(columns=['month', *ROLLUP_KEYS.values(), 'transactions', 'amount', 'income', 'expenses', 'amount_currency'])
+
+    amounts = pd.to_numeric(df['Amount'], errors='coerce').fillna(0.0)
+    keys = {'month': partition_keys(df['Date']).to_numpy()}
+    keys.update({name: df[column].astype(object).fillna('').to_numpy() if column in df.columns else '' for column, name in ROLLUP_KEYS.items()})
+    rows = pd.DataFrame({
+        **keys,
+        'transactions': 1,
+        'amount': amounts.to_numpy(),
+        'income': amounts.where(amounts > 0, 0.0).to_numpy(),
+        'expenses': amounts.where(amounts < 0, 0.0).to_numpy(),
+        'amount_currency': pd.to_numeric(df['Amount_currency'], errors='coerce').fillna(0.0).to_numpy() if 'Amount_currency' in df.columns else 0.0,
+    })
+    return rows.groupby(['month', *ROLLUP_KEYS.values()], sort=False, as_index=False).sum()
+
+
+class RollupStore:
+    # Materialized monthly totals of a ledger, kept in SQLite next to the partitions, so
+    # monthly and yearly summaries are a small GROUP BY instead of reading every partition.
+    # Imports add the aggregates of their new rows and re-categorization moves the changed
+    # rows from their old categories to the new ones. Each month records the partition
+    # version it reflects: a month changed some other way (a backup restore, an edited
+    # partition) no longer matches and is rebuilt from its partition on the next summary.
+    def __init__(self, ledger_dir):
+        self.ledger_dir = ledger_dir
+        self.rollup_path = os.path.join(ledger_dir, ROLLUP_FILE)
+
+    def _connect(self):
+        connection = sqlite3.connect(self.rollup_path)
+        connection.execute('CREATE TABLE IF NOT EXISTS rollups (month TEXT, bank TEXT, main_category TEXT, sub_category TEXT, currency TEXT, '
+                           'transactions INTEGER, amount REAL, income REAL, expenses REAL, amount_currency REAL, '
+                           'PRIMARY KEY (month, bank, main_category, sub_category, currency)) WITHOUT ROWID')
+        connection.execute('CREATE TABLE IF NOT EXISTS months (month TEXT PRIMARY KEY, version INTEGER)')
+        return connection
+
+    # Partition version each month of the rollups reflects
+    def versions(self):
+        connection = self._connect()
+        try:
+            return dict(connection.execute('SELECT month, version FROM months'))
+        finally:
+            connection.close()
+
+    def _add(self, connection, aggregates, sign):
+        columns = ['month', *ROLLUP_KEYS.values(), 'transactions', 'amount', 'income', 'expenses', 'amount_currency']
+        totals = ('transactions', 'amount', 'income', 'expenses', 'amount_currency')
+        connection.executemany(
+            f'INSERT INTO rollups ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))}) '
+            f'ON CONFLICT (month, {", ".join(ROLLUP_KEYS.values())}) DO UPDATE SET {", ".join(f"{name} = {name} + excluded.{name}" for name in totals)}',
+            ([*row[:5], sign * int(row[5]), *(sign * float(value) for value in row[6:])] for row in aggregates[columns].itertuples(index=False)))
+
+    ### INCREMENTAL UPDATES
+
+    # Apply the rows removed from and added to partitions. old_versions holds each touched
+    # partition's version before the change (None for a partition that did not exist) and
+    # new_versions the one after it. A month is only updated incrementally if the rollups
+    # were up to date with it before; otherwise it is left to be rebuilt.
+    def apply(self, old_versions, new_versions, removed=None, added=None):
+        connection = self._connect()
+        try:
+            recorded = dict(connection.execute('SELECT month, version FROM months'))
+            current = {key for key, version in old_versions.items() if recorded.get(key) == version}
+
+            for rows, sign in ((removed, -1), (added, 1)):
+                if rows is not None and not rows.empty:
+                    aggregates = aggregate_rows(rows)
+                    self._add(connection, aggregates[aggregates['month'].isin(current)], sign)
+
+            connection.execute('DELETE FROM rollups WHERE transactions = 0')
+            connection.executemany('INSERT OR REPLACE INTO months (month, version) VALUES (?, ?)',
+                                   ((key, new_versions.get(key, 0)) for key in current))
+            connection.commit()
+        finally:
+            connection.close()
+
+    ### REBUILDING
+
+    # Months whose partition changed without the rollups being told, and months whose
+    # partition is gone
+    def stale_months(self):
+        store = LedgerStore(self.ledger_dir)
+        versions = store.versions()
+        recorded = self.versions()
+        partitions = store.partitions()
+        stale = [key for key in partitions if recorded.get(key) != versions.get(key, 0)]
+        removed = [key for key in recorded if key not in partitions]
+        return stale, removed
+
+    # Recompute the given months from their partitions (default: the stale ones)
+    def rebuild(self, months=None):
+        store = LedgerStore(self.ledger_dir)
+        if months is None:
+            months, removed = self.stale_months()
+        else:
+            removed = []
+        if not months and not removed:
+            return []
+
+        versions = store.versions()
+        columns = ['Date', 'Amount', 'Amount_currency', *ROLLUP_KEYS]
+        connection = self._connect()
+        try:
+            for key in list(months) + removed:
+                connection.execute('DELETE FROM rollups WHERE month = ?', (key,))
+                connection.execute('DELETE FROM months WHERE month = ?', (key,))
+
+            for key in months:
+                available = store.partition_columns(key)
+                self._add(connection, aggregate_rows(store.read_partition(key, columns=[column for column in columns if column in available])), 1)
+                connection.execute('INSERT INTO months (month, version) VALUES (?, ?)', (key, versions.get(key, 0)))
+            connection.commit()
+        finally:
+            connection.close()
+
+        print(f"Rebuilt monthly rollups for {len(months)} month(s) of {self.ledger_dir}")
+        return months
+
+    ### SUMMARIES
+
+    # Totals per month (optionally only the given year or months), grouped by one of
+    # SUMMARY_GROUPS. Stale months are rebuilt first, so the answer always matches the ledger.
+    def monthly_summary(self, year=None, months=None, by='category'):
+        self.rebuild()
+        return self._summary('month', year, months, by)
+
+    def yearly_summary(self, year=None, by='category'):
+        self.rebuild()
+        return self._summary("substr(month, 1, 4)", year, None, by)
+
+    def _summary(self, period, year, months, by):
+        groups = SUMMARY_GROUPS[by]
+        conditions, parameters = [], []
+        if year is not None:
+            conditions.append('month LIKE ?')
+            parameters.append(f'{year}-%')
+        if period != 'month':
+            # Undated rows belong to no year
+            conditions.append('month != ?')
+            parameters.append(UNDATED_PARTITION)
+        if months:
+            conditions.append(f'month IN ({", ".join("?" * len(months))})')
+            parameters.extend(months)
+
+        query = (f'SELECT {period} AS period, {", ".join(groups)}, SUM(transactions) AS transactions, '
+                 'ROUND(SUM(income), 2) AS income, ROUND(SUM(expenses), 2) AS expenses, ROUND(SUM(amount), 2) AS total '
+                 f'FROM rollups {"WHERE " + " AND ".join(conditions) if conditions else ""} '
+                 f'GROUP BY period, {", ".join(groups)} ORDER BY period, {", ".join(groups)}')
+        connection = self._connect()
+        try:
+            return pd.read_sql_query(query, connection, params=parameters)
+        finally:
+            connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Monthly and yearly totals of a ledger from its materialized rollups")
+    parser.add_argument('ledger', help="ledger directory")
+    parser.add_argument('--year', help="only this year (YYYY)")
+    parser.add_argument('--month', action='append', help="only this month (YYYY-MM); can be repeated")
+    parser.add_argument('--by', choices=list(SUMMARY_GROUPS), default='category', help="what to group the totals by")
+    parser.add_argument('--yearly', action='store_true', help="totals per year instead of per month")
+    parser.add_argument('--rebuild', action='store_true', help="recompute every month from the partitions")
+    args = parser.parse_args()
+
+    rollups = RollupStore(args.ledger)
+    if args.rebuild:
+        rollups.rebuild(LedgerStore(args.ledger).partitions())
+
+    if args.yearly:
+        summary = rollups.yearly_summary(args.year, args.by)
+    else:
+        summary = rollups.monthly_summary(args.year, args.month, args.by)
+
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print(summary.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
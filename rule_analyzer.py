@@ -0,0 +1,153 @@
+import argparse
+import json
+
+import pandas as pd
+
+from ledger import LedgerStore
+
+# How many rules print_rule_analysis lists per section
+REPORT_LIMIT = 25
+
+
+### SHADOWED RULES
+
+# Find rules that can never match under first-match prefix semantics.
+# A rule is unreachable exactly when an earlier rule's keyword is a prefix of its keyword
+# (an equal keyword included): every description starting with the longer keyword also
+# starts with the earlier one, and the earlier rule wins.
+#
+# Sorting the keywords puts every keyword right after its prefixes, so one pass with a
+# stack of the current keyword's prefixes (each carrying the earliest rule along the
+# chain) finds the winner for every rule: O(n log n) instead of comparing all pairs.
+def find_shadowed_rules(rules):
+    entries = sorted((str(rule['Keyword']).lower(), index) for index, rule in enumerate(rules) if rule.get('Keyword') is not None)
+
+    shadowed = []
+    stack = []  # (keyword, earliest rule index among this keyword and its prefixes)
+    for keyword, index in entries:
+        while stack and not keyword.startswith(stack[-1][0]):
+            stack.pop()
+
+        winner = stack[-1][1] if stack else None
+        if winner is not None and winner < index:
+            rule, winning_rule = rules[index], rules[winner]
+            shadowed.append({
+                'index': index,
+                'keyword': rule['Keyword'],
+                'Main Category': rule.get('Main Category'),
+                'Sub Category': rule.get('Sub Category'),
+                'shadowed_by': winner,
+                'shadowed_by_keyword': winning_rule['Keyword'],
+                # Same categories: dead weight. Different categories: the rule was meant to win
+                'same_category': (rule.get('Main Category'), rule.get('Sub Category')) == (winning_rule.get('Main Category'), winning_rule.get('Sub Category')),
+            })
+            stack.append((keyword, winner))
+        else:
+            stack.append((keyword, index))
+
+    return sorted(shadowed, key=lambda entry: entry['index'])
+
+
+### HIT STATISTICS
+
+# Rows matched per keyword and the date it last matched, from the ledger's 'Rule' column.
+# Only the Date and Rule columns are read. Partitions from before 'Rule' was recorded are
+# counted as unknown.
+def rule_hit_counts(ledger_dir):
+    store = LedgerStore(ledger_dir)
+    frames = []
+    unknown_rows = 0
+
+    for key in store.partitions():
+        if 'Rule' in store.partition_columns(key):
+            frames.append(store.read_partition(key, columns=['Date', 'Rule']))
+        else:
+            unknown_rows += len(store.read_partition(key, columns=['Date']))
+
+    if not frames:
+        return pd.DataFrame(columns=['hits', 'last_matched']), unknown_rows
+
+    df = pd.concat(frames, ignore_index=True)
+    df['Rule'] = df['Rule'].astype(object).fillna('')
+    hits = df.groupby('Rule', sort=False).agg(hits=('Date', 'size'), last_matched=('Date', 'max'))
+    return hits, unknown_rows
+
+
+### REPORT
+
+def analyze_rules(rules, ledger_dir=None):
+    shadowed = find_shadowed_rules(rules)
+    report = {
+        'rules': len(rules),
+        'shadowed': shadowed,
+        'conflicting_shadowed': [entry for entry in shadowed if not entry['same_category']],
+    }
+
+    if ledger_dir is None:
+        return report
+
+    hits, unknown_rows = rule_hit_counts(ledger_dir)
+    shadowed_indexes = {entry['index'] for entry in shadowed}
+
+    statistics = []
+    for index, rule in enumerate(rules):
+        if rule.get('Keyword') is None or index in shadowed_indexes:
+            continue
+        keyword = str(rule['Keyword']).lower()
+        rule_hits = int(hits.at[keyword, 'hits']) if keyword in hits.index else 0
+        last_matched = hits.at[keyword, 'last_matched'] if keyword in hits.index else None
+        statistics.append({
+            'index': index,
+            'keyword': rule['Keyword'],
+            'hits': rule_hits,
+            'last_matched': None if last_matched is None or pd.isna(last_matched) else last_matched.strftime('%Y-%m-%d'),
+        })
+
+    report['statistics'] = sorted(statistics, key=lambda entry: (-entry['hits'], entry['index']))
+    report['unused'] = [entry for entry in statistics if entry['hits'] == 0]
+    report['uncategorized_rows'] = int(hits.at['', 'hits']) if '' in hits.index else 0
+    report['rows_without_rule'] = unknown_rows
+    return report
+
+
+def print_rule_analysis(report, limit=REPORT_LIMIT):
+    print(f"{report['rules']} rules, {len(report['shadowed'])} unreachable "
+          f"({len(report['conflicting_shadowed'])} with different categories than the rule shadowing them)")
+
+    for entry in report['conflicting_shadowed'][:limit]:
+        print(f"  #{entry['index']} '{entry['keyword']}' ({entry['Main Category']} / {entry['Sub Category']}) "
+              f"is shadowed by #{entry['shadowed_by']} '{entry['shadowed_by_keyword']}'")
+
+    if 'statistics' not in report:
+        return
+
+    print("Most used rules:")
+    for entry in report['statistics'][:limit]:
+        print(f"  #{entry['index']:<5} {entry['hits']:>8} hits  last {entry['last_matched']}  '{entry['keyword']}'")
+
+    print(f"{len(report['unused'])} reachable rules never matched a ledger row")
+    print(f"{report['uncategorized_rows']} uncategorized rows")
+    if report['rows_without_rule']:
+        print(f"{report['rows_without_rule']} rows were categorized before matched keywords were recorded")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find unreachable categorization rules and report how often each rule matches")
+    parser.add_argument('rules', help="categorization rules JSON file")
+    parser.add_argument('--ledger', help="ledger directory to count rule hits in")
+    parser.add_argument('--json', help="write the full analysis to this JSON file")
+    args = parser.parse_args()
+
+    with open(args.rules, 'r') as json_file:
+        rules = json.load(json_file)
+
+    report = analyze_rules(rules, args.ledger)
+    print_rule_analysis(report)
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(report, json_file, indent=4, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+import contextlib
+import cProfile
+import json
+import os
+import platform
+import pstats
+import time
+import tracemalloc
+
+# Functions listed per profiled stage, by cumulative time
+PROFILE_TOP_FUNCTIONS = 20
+
+# The report of the run in progress; stage() does nothing but time keeping without one
+_active = None
+
+
+class RunReport:
+    # Machine-readable record of one pipeline run: one entry per stage with wall time,
+    # status and whatever counters the stage reports (rows in/out, duplicates dropped,
+    # uncategorized rows, ...), plus run-wide counters.
+    # Stages can nest (conversion runs inside extraction); cProfile and tracemalloc can
+    # only watch one stage at a time, so they are applied to top-level stages only.
+    def __init__(self, profile=False, trace_memory=False):
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.started = time.time()
+        self._started_clock = time.perf_counter()
+        self.stages = []
+        self.counters = {}
+        self._depth = 0
+
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        entry = {'stage': name, 'depth': self._depth, 'offset': round(time.perf_counter() - self._started_clock, 4)}
+        entry.update(fields)
+        self.stages.append(entry)
+
+        top_level = self._depth == 0
+        profiler = cProfile.Profile() if self.profile and top_level else None
+        traced = self.trace_memory and top_level
+        started_tracing = traced and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        elif traced:
+            tracemalloc.reset_peak()
+
+        self._depth += 1
+        started = time.perf_counter()
+        if profiler:
+            profiler.enable()
+        try:
+            yield entry
+            entry['status'] = 'ok'
+        except Exception as e:
+            entry['status'] = 'failed'
+            entry['error'] = f"{type(e).__name__}: {str(e)}"
+            raise
+        finally:
+            if profiler:
+                profiler.disable()
+                entry['profile'] = _top_functions(profiler)
+            entry['seconds'] = round(time.perf_counter() - started, 4)
+            if traced:
+                entry['peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+            if started_tracing:
+                tracemalloc.stop()
+            self._depth -= 1
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    # Add the stages and counters another process recorded (a batch worker extracting one
+    # file), nested under the stage in progress. started is that report's start time; its
+    # stage offsets are moved onto this report's clock.
+    def merge(self, stages, counters, started):
+        shift = started - self.started
+        for entry in stages:
+            self.stages.append(dict(entry, depth=entry['depth'] + self._depth, offset=round(entry['offset'] + shift, 4)))
+        for name, value in counters.items():
+            self.count(name, value)
+
+    def to_dict(self):
+        return {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'seconds': round(time.perf_counter() - self._started_clock, 4),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'status': 'failed' if any(entry.get('status') == 'failed' for entry in self.stages) else 'ok',
+            'counters': self.counters,
+            'stages': self.stages,
+        }
+
+    def write(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path + '.tmp', 'w') as json_file:
+            json.dump(self.to_dict(), json_file, indent=4, default=str)
+        os.replace(path + '.tmp', path)
+
+
+def _top_functions(profiler):
+    stats = pstats.Stats(profiler).stats
+    rows = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:PROFILE_TOP_FUNCTIONS]
+    return [{'function': f'{file_name}:{line}({function})', 'calls': calls, 'own_seconds': round(own, 4), 'cumulative_seconds': round(cumulative, 4)}
+            for (file_name, line, function), (_, calls, own, cumulative, _) in rows]
+
+
+### RUN CONTROL
+
+def start_run(profile=False, trace_memory=False):
+    global _active
+    _active = RunReport(profile, trace_memory)
+    return _active
+
+
+# End the run and write its report; returns the report
+def finish_run(path=None):
+    global _active
+    report, _active = _active, None
+    if report is not None and path:
+        report.write(path)
+        print(f"Run report written: {path}")
+    return report
+
+
+def current_run():
+    return _active
+
+
+# Time a pipeline stage in the current run. Yields a dict the stage adds its counters to;
+# without a run in progress the dict is simply discarded.
+@contextlib.contextmanager
+def stage(name, **fields):
+    if _active is None:
+        yield dict(fields)
+    else:
+        with _active.stage(name, **fields) as entry:
+            yield entry
+
+
+def count(name, value=1):
+    if _active is not None:
+        _active.count(name, value)
+
+
+def merge(stages, counters, started):
+    if _active is not None:
+        _active.merge(stages, counters, started)
+
+
+# Default report file for a run: <report_dir>/run_YYYYmmdd_HHMMSS.json
+def report_path(report_dir):
+    return os.path.join(report_dir, f'run_{time.strftime("%Y%m%d_%H%M%S")}.json')
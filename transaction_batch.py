@@ -0,0 +1,140 @@
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+# Fixed schema of a batch: column -> dtype of its array.
+# Low-cardinality text columns are pandas Categoricals (integer codes plus one copy of each
+# distinct value); everything else is a plain NumPy array.
+TRANSACTION_SCHEMA = {
+    'Date': 'datetime64[ns]',
+    'Description': object,
+    'Amount': np.float64,
+    'Amount_currency': np.float64,
+    'Currency': 'category',
+    'Currency_Rate': np.float64,
+    'Bank': 'category',
+    'UniqueID': object,
+}
+
+# Added by categorization; a batch either has all of them or none
+CATEGORY_SCHEMA = {
+    'Main Category': 'category',
+    'Sub Category': 'category',
+    'Rule': object,
+}
+
+# Text dates accepted from older callers (lists of dicts) are in the old ledger format
+TEXT_DATE_FORMAT = '%d-%m-%Y'
+
+
+# Convert one column to the array type its schema entry asks for
+def _to_array(values, dtype):
+    if dtype is object:
+        return values.to_numpy(dtype=object)
+    if dtype == 'category':
+        return values.array if isinstance(values.dtype, pd.CategoricalDtype) else pd.Categorical(values)
+    if dtype == 'datetime64[ns]':
+        if not pd.api.types.is_datetime64_any_dtype(values):
+            values = pd.to_datetime(values, format=TEXT_DATE_FORMAT, errors='coerce')
+        return values.to_numpy(dtype='datetime64[ns]')
+    # Text such as the '' Wise uses for missing amounts becomes NaN
+    return pd.to_numeric(values, errors='coerce').to_numpy(dtype=dtype, copy=False)
+
+
+def _empty_array(dtype):
+    if dtype == 'category':
+        return pd.Categorical([])
+    return np.empty(0, dtype=dtype)
+
+
+def _concat_arrays(arrays):
+    if isinstance(arrays[0], pd.Categorical):
+        return union_categoricals([pd.Categorical(array) for array in arrays])
+    return np.concatenate(arrays)
+
+
+class TransactionBatch:
+    # Columnar batch of transactions passed between the pipeline stages.
+    # Each column is one NumPy array or Categorical, so a row costs a few machine words
+    # instead of a dict, and converting to and from pandas reuses the arrays (zero-copy
+    # for the numeric and categorical columns) instead of rebuilding the frame row by row.
+    __slots__ = ('columns',)
+
+    def __init__(self, columns):
+        lengths = {len(values) for values in columns.values()}
+        if len(lengths) > 1:
+            raise ValueError(f"Columns have different lengths: {sorted(lengths)}")
+        self.columns = columns
+
+    ### CONSTRUCTION
+
+    @classmethod
+    def empty(cls):
+        return cls({name: _empty_array(dtype) for name, dtype in TRANSACTION_SCHEMA.items()})
+
+    @classmethod
+    def from_pandas(cls, df):
+        schema = dict(TRANSACTION_SCHEMA)
+        if all(name in df.columns for name in CATEGORY_SCHEMA):
+            schema.update(CATEGORY_SCHEMA)
+
+        return cls({name: _to_array(df[name], dtype) for name, dtype in schema.items()})
+
+    @classmethod
+    def from_records(cls, records):
+        if not records:
+            return cls.empty()
+        return cls.from_pandas(pd.DataFrame.from_records(records))
+
+    # Accept a TransactionBatch, DataFrame, list of dicts or None
+    @classmethod
+    def coerce(cls, transactions):
+        if isinstance(transactions, cls):
+            return transactions
+        if transactions is None:
+            return cls.empty()
+        if isinstance(transactions, pd.DataFrame):
+            return cls.from_pandas(transactions)
+        return cls.from_records(list(transactions))
+
+    @classmethod
+    def concat(cls, batches):
+        batches = [batch for batch in batches if len(batch)]
+        if not batches:
+            return cls.empty()
+        names = [name for name in batches[0].columns if all(name in batch.columns for batch in batches)]
+        return cls({name: _concat_arrays([batch.columns[name] for batch in batches]) for name in names})
+
+    ### ACCESS
+
+    def __len__(self):
+        return len(self.columns['Date'])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def is_categorized(self):
+        return all(name in self.columns for name in CATEGORY_SCHEMA)
+
+    # New batch sharing the existing arrays, with columns added or replaced
+    def with_columns(self, **columns):
+        merged = dict(self.columns)
+        merged.update({name: values if isinstance(values, pd.Categorical) else np.asarray(values) for name, values in columns.items()})
+        return TransactionBatch(merged)
+
+    def slice(self, start, stop):
+        return TransactionBatch({name: values[start:stop] for name, values in self.columns.items()})
+
+    ### CONVERSION
+
+    def to_pandas(self):
+        return pd.DataFrame(self.columns, copy=False)
+
+    def to_records(self):
+        return self.to_pandas().to_dict(orient='records')
+
+    def __repr__(self):
+        return f"TransactionBatch({len(self)} rows, columns={list(self.columns)})"
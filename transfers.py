@@ -0,0 +1,193 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from ledger import UNDATED_PARTITION, LedgerStore
+from ledger_parquet import sync_parquet_mirror
+from rollups import RollupStore
+from run_report import stage
+
+# Column that holds the UniqueID of the other half of an internal transfer
+TRANSFER_COLUMN = 'Transfer'
+
+# Days between the withdrawal and the deposit of one transfer
+TRANSFER_WINDOW_DAYS = 3
+
+# Largest relative difference between the two DKK amounts. Transfers in the same currency
+# match exactly; across currencies the banks' exchange rates and fees differ a little.
+AMOUNT_TOLERANCE = 0.02
+
+
+### MATCHING
+
+# Pair withdrawals with deposits at another bank. df needs Date, Amount (DKK) and Bank;
+# returns two arrays of row positions (withdrawal, deposit), one entry per pair.
+#
+# Instead of comparing every withdrawal with every deposit, both sides get a sort key of
+# (amount band, day). The bands are logarithmic and one tolerance wide, so a matching
+# amount is always in the same or a neighbouring band, and everything within the date
+# window of a withdrawal is one contiguous run of the sorted deposits: three binary
+# searches per withdrawal find all candidates. Candidates are then filtered on bank and
+# exact tolerance, and paired greedily from the closest match on, each row used once.
+# That is O(n log n) plus the (small) number of candidates inside the windows.
+def find_transfer_pairs(df, window_days=TRANSFER_WINDOW_DAYS, tolerance=AMOUNT_TOLERANCE):
+    amounts = pd.to_numeric(df['Amount'], errors='coerce').to_numpy(dtype=np.float64)
+    dates = pd.to_datetime(df['Date']).to_numpy(dtype='datetime64[D]')
+    banks = pd.Categorical(df['Bank'].astype(object).fillna('')).codes
+
+    usable = ~np.isnan(amounts) & (amounts != 0) & ~np.isnat(dates)
+    outgoing = np.flatnonzero(usable & (amounts < 0))
+    incoming = np.flatnonzero(usable & (amounts > 0))
+    if not len(outgoing) or not len(incoming):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    days = dates.astype(np.int64)
+    first_day = days[usable].min()
+    span = days[usable].max() - first_day + 2 * window_days + 1
+    # Amounts within the tolerance differ by at most this much in log scale
+    band_width = -np.log1p(-tolerance)
+    bands = np.floor(np.log(np.abs(amounts, where=usable, out=np.ones_like(amounts))) / band_width).astype(np.int64)
+
+    def sort_key(positions, day_offset):
+        return bands[positions] * span + (days[positions] - first_day + window_days + day_offset)
+
+    incoming = incoming[np.argsort(sort_key(incoming, 0), kind='stable')]
+    incoming_keys = sort_key(incoming, 0)
+    # Searching in key order keeps the binary searches in cache
+    outgoing = outgoing[np.argsort(sort_key(outgoing, 0), kind='stable')]
+
+    # Candidate runs of the sorted deposits for each withdrawal and neighbouring band
+    out_candidates, in_candidates = [], []
+    for band_offset in (-1, 0, 1):
+        low = np.searchsorted(incoming_keys, sort_key(outgoing, -window_days) + band_offset * span, side='left')
+        high = np.searchsorted(incoming_keys, sort_key(outgoing, window_days) + band_offset * span, side='right')
+        lengths = high - low
+        starts = np.repeat(low - np.cumsum(lengths) + lengths, lengths)
+        out_candidates.append(np.repeat(outgoing, lengths))
+        in_candidates.append(incoming[starts + np.arange(lengths.sum())])
+
+    out_candidates = np.concatenate(out_candidates)
+    in_candidates = np.concatenate(in_candidates)
+
+    withdrawn = -amounts[out_candidates]
+    deposited = amounts[in_candidates]
+    difference = np.abs(withdrawn - deposited) / np.maximum(withdrawn, deposited)
+    keep = (banks[out_candidates] != banks[in_candidates]) & (difference <= tolerance)
+    out_candidates, in_candidates, difference = out_candidates[keep], in_candidates[keep], difference[keep]
+
+    # Closest amounts (to a millionth) first, then closest dates, then the earliest withdrawal,
+    # as one integer key: a single argsort is much faster than a lexsort over three columns
+    day_gap = np.abs(days[out_candidates] - days[in_candidates])
+    priority = (np.round(difference * 1e6).astype(np.int64) * (window_days + 1) + day_gap) * span + (days[out_candidates] - first_day)
+    order = np.argsort(priority, kind='stable')
+
+    used = set()
+    pairs_out, pairs_in = [], []
+    for out_position, in_position in zip(out_candidates[order].tolist(), in_candidates[order].tolist()):
+        if out_position not in used and in_position not in used:
+            used.add(out_position)
+            used.add(in_position)
+            pairs_out.append(out_position)
+            pairs_in.append(in_position)
+
+    return np.array(pairs_out, dtype=np.int64), np.array(pairs_in, dtype=np.int64)
+
+
+### LEDGER
+
+# The given month partitions and the months next to them, where the other half of a
+# transfer from those months can be (the date window is much shorter than a month)
+def neighbouring_partitions(keys):
+    months = pd.PeriodIndex([key for key in keys if key != UNDATED_PARTITION], freq='M')
+    neighbours = months.append(months - 1).append(months + 1)
+    return sorted(set(neighbours.strftime('%Y-%m')))
+
+
+# Find internal transfers among the ledger rows not paired yet and mark both rows of each
+# pair with the other's UniqueID in the 'Transfer' column. Pairs found earlier are kept.
+# Only the Date, Amount, Bank, UniqueID and Transfer columns are read for the matching;
+# partitions are rewritten only when one of their rows was paired.
+# Pairs are written back by UniqueID, so rows that share their UniqueID with another row of
+# their partition (genuine repeats the dedup keeps) are left out: marking one would mark all.
+# With keys (the partitions an import appended to) only those months and their neighbours
+# are searched, so the cost follows the import instead of the ledger size.
+def match_ledger_transfers(ledger_dir, window_days=TRANSFER_WINDOW_DAYS, tolerance=AMOUNT_TOLERANCE, keys=None):
+    try:
+        with stage('transfers') as info:
+            store = LedgerStore(ledger_dir)
+            partitions = store.partitions()
+            if keys is not None:
+                wanted = set(neighbouring_partitions(keys))
+                partitions = [key for key in partitions if key in wanted]
+
+            frames = []
+            repeated_rows = 0
+            for key in partitions:
+                has_transfers = TRANSFER_COLUMN in store.partition_columns(key)
+                df = store.read_partition(key, columns=['Date', 'Amount', 'Bank', 'UniqueID'] + ([TRANSFER_COLUMN] if has_transfers else []))
+                repeated = df['UniqueID'].astype(str).duplicated(keep=False)
+                repeated_rows += int(repeated.sum())
+                df = df[~repeated]
+                if has_transfers:
+                    df = df[df[TRANSFER_COLUMN].isna()]
+                frames.append(df[['Date', 'Amount', 'Bank', 'UniqueID']].assign(partition=key))
+
+            if not frames:
+                return 0
+
+            df = pd.concat(frames, ignore_index=True)
+            info['rows_in'] = len(df)
+            info['repeated_ids_skipped'] = repeated_rows
+            pairs_out, pairs_in = find_transfer_pairs(df, window_days, tolerance)
+            info['pairs'] = len(pairs_out)
+            if not len(pairs_out):
+                print("No new internal transfers found.")
+                return 0
+
+            ids = df['UniqueID'].astype(str).to_numpy()
+            marked = pd.DataFrame({
+                'partition': df['partition'].to_numpy()[np.concatenate([pairs_out, pairs_in])],
+                'UniqueID': ids[np.concatenate([pairs_out, pairs_in])],
+                TRANSFER_COLUMN: ids[np.concatenate([pairs_in, pairs_out])],
+            })
+
+            updated = []
+            rollups = RollupStore(ledger_dir)
+            for key, rows in marked.groupby('partition', sort=True):
+                old_version = store.versions().get(key, 0)
+                store.set_values(key, TRANSFER_COLUMN, rows['UniqueID'], rows[TRANSFER_COLUMN])
+                updated.append(key)
+                # Amounts and categories are unchanged, so the monthly totals only move to the new version
+                rollups.apply({key: old_version}, store.versions())
+
+            info['partitions_rewritten'] = len(updated)
+            sync_parquet_mirror(ledger_dir, updated)
+            print(f"Matched {len(pairs_out)} internal transfer(s) in {len(updated)} partition(s) of {ledger_dir}")
+            return len(pairs_out)
+
+    except Exception as e:
+        print(f"An error occurred in match_ledger_transfers: {str(e)}")
+        return 0
+
+
+# Drop both rows of every matched transfer, so totals only show money leaving or entering
+# one's own accounts
+def net_transfers(df):
+    if TRANSFER_COLUMN not in df.columns:
+        return df
+    return df[df[TRANSFER_COLUMN].isna()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pair withdrawals and deposits that move money between your own accounts")
+    parser.add_argument('ledger', help="ledger directory")
+    parser.add_argument('--window-days', type=int, default=TRANSFER_WINDOW_DAYS, help="days allowed between the two halves of a transfer")
+    parser.add_argument('--tolerance', type=float, default=AMOUNT_TOLERANCE, help="largest relative difference between the DKK amounts")
+    args = parser.parse_args()
+
+    match_ledger_transfers(args.ledger, args.window_days, args.tolerance)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+import argparse
+import json
+import os
+import time
+
+from bank_formats import detect_bank
+from batch_import import STATEMENT_EXTENSIONS
+from category_cache import CategoryCache
+from excel_export import export_monthly_workbooks
+from ledger import LedgerStore
+from main import (categorize_transactions, extract_statement, load_categorization_rules,
+                  process_and_export_data, update_existing_category)
+from pdf_extract import file_digest
+from run_report import finish_run, report_path, start_run
+from transaction_batch import TransactionBatch
+from transfers import match_ledger_transfers
+
+IMPORTS_FILE = '_imports.json'
+
+# A file must keep the same size and modification time for this long before it is
+# imported, so statements that are still downloading are left alone
+SETTLE_SECONDS = 5
+
+POLL_SECONDS = 10
+
+# Partial downloads of the common browsers
+PARTIAL_EXTENSIONS = ('.crdownload', '.part', '.partial', '.download', '.tmp')
+
+# Lock files Excel and Word keep next to an open document (~$statement.xlsx)
+LOCK_FILE_PREFIX = '~$'
+
+
+class ImportManifest:
+    # Content hashes of every statement already imported into a ledger, kept in the ledger
+    # directory. A statement downloaded again (under any name) hashes the same and is
+    # skipped before it is parsed, converted or hashed row by row.
+    def __init__(self, ledger_dir):
+        os.makedirs(ledger_dir, exist_ok=True)
+        self.path = os.path.join(ledger_dir, IMPORTS_FILE)
+        try:
+            with open(self.path, 'r') as json_file:
+                self.imports = json.load(json_file)
+        except FileNotFoundError:
+            self.imports = {}
+
+    def __contains__(self, digest):
+        return digest in self.imports
+
+    def add(self, digest, file_path, bank, rows):
+        self.imports[digest] = {'file': os.path.basename(file_path), 'bank': bank, 'rows': rows,
+                                'imported': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as json_file:
+            json.dump(self.imports, json_file, indent=4)
+        os.replace(self.path + '.tmp', self.path)
+
+
+class FolderWatcher:
+    # Polls a folder (such as Downloads) and imports every new bank statement that shows up.
+    # Files are recognised by their header, identified by content hash and hashed only
+    # once per size/modification time, so an idle poll costs a directory listing.
+    def __init__(self, watch_dir, ledger_dir, categorization_rules_path, excel_dir=None, report_dir=None):
+        self.watch_dir = watch_dir
+        self.ledger_dir = ledger_dir
+        self.categorization_rules_path = categorization_rules_path
+        self.excel_dir = excel_dir
+        self.report_dir = report_dir
+        self.manifest = ImportManifest(ledger_dir)
+        self.category_cache = CategoryCache(ledger_dir)
+        self._seen = {}       # path -> (size, mtime_ns, digest or None while settling, first seen)
+        self._ignored = set()  # digests of files no bank format recognises
+
+    # Statement files whose content has not been imported yet and that stopped changing
+    def _new_files(self):
+        now = time.time()
+        ready = []
+        ready_digests = set()
+
+        for file_name in sorted(os.listdir(self.watch_dir)):
+            path = os.path.join(self.watch_dir, file_name)
+            if (not file_name.lower().endswith(STATEMENT_EXTENSIONS) or file_name.lower().endswith(PARTIAL_EXTENSIONS)
+                    or file_name.startswith(LOCK_FILE_PREFIX) or not os.path.isfile(path)):
+                continue
+
+            stat = os.stat(path)
+            seen = self._seen.get(path)
+            if seen is None or seen[:2] != (stat.st_size, stat.st_mtime_ns):
+                # New or still changing: wait until it has settled
+                self._seen[path] = (stat.st_size, stat.st_mtime_ns, None, now)
+                continue
+
+            digest = seen[2]
+            if digest is None:
+                if now - seen[3] < SETTLE_SECONDS:
+                    continue
+                digest = file_digest(path)
+                self._seen[path] = (stat.st_size, stat.st_mtime_ns, digest, seen[3])
+
+            # The same statement saved twice under different names is imported once
+            if digest not in self.manifest and digest not in self._ignored and digest not in ready_digests:
+                ready.append((path, digest))
+                ready_digests.add(digest)
+
+        # Forget files that were moved away
+        for path in [path for path in self._seen if not os.path.isfile(path)]:
+            del self._seen[path]
+
+        return ready
+
+    # Import whatever is new right now; returns the number of files imported
+    def scan(self):
+        new_files = self._new_files()
+        if not new_files:
+            return 0
+
+        if self.report_dir:
+            start_run()
+
+        # Refuses to run against a ledger built with another UniqueID scheme
+        id_scheme = LedgerStore(self.ledger_dir).id_scheme()
+
+        batches = []
+        imported = []
+        for path, digest in new_files:
+            try:
+                bank = detect_bank(path)
+            except Exception as e:
+                print(f"An error occurred while detecting the bank of {path}: {type(e).__name__}: {str(e)}")
+                bank = None
+            if bank is None:
+                print(f"Skipping {path}: not a statement of a known bank")
+                self._ignored.add(digest)
+                continue
+
+            try:
+                transactions = extract_statement(path, bank, id_scheme, strict=True)
+            except Exception as e:
+                print(f"An error occurred while importing {path}: {type(e).__name__}: {str(e)}")
+                self._ignored.add(digest)
+                continue
+
+            batches.append(transactions)
+            imported.append((digest, path, bank, len(transactions)))
+
+        if imported:
+            categorization_rules_list = load_categorization_rules(self.categorization_rules_path)
+            categorized = categorize_transactions(TransactionBatch.concat(batches), categorization_rules_list, self.category_cache)
+            update_existing_category(self.ledger_dir, self.categorization_rules_path, self.category_cache)
+            try:
+                appended = process_and_export_data(categorized, self.ledger_dir, strict=True)
+            except Exception as e:
+                # Not recorded, so the files are imported again on the next poll
+                print(f"An error occurred while exporting {len(imported)} statement(s): {type(e).__name__}: {str(e)}")
+                imported = []
+
+        if imported:
+            match_ledger_transfers(self.ledger_dir, keys=list(appended))
+
+            for digest, path, bank, rows in imported:
+                self.manifest.add(digest, path, bank, rows)
+                print(f"Imported {path} as {bank} ({rows} rows)")
+            self.manifest.save()
+
+            if self.excel_dir:
+                export_monthly_workbooks(self.ledger_dir, self.excel_dir)
+
+        if self.report_dir:
+            finish_run(report_path(self.report_dir))
+
+        return len(imported)
+
+    # Files already in the folder when watching starts are imported on the first polls
+    def watch(self, interval=POLL_SECONDS):
+        print(f"Watching {self.watch_dir} for new statements (Ctrl+C to stop)")
+        try:
+            while True:
+                self.scan()
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            print("Stopped watching")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import new bank statements as they appear in a folder")
+    parser.add_argument('folder', help="folder to watch, e.g. Downloads")
+    parser.add_argument('--ledger', required=True, help="ledger directory")
+    parser.add_argument('--rules', default='categorization_rules.json', help="categorization rules JSON file")
+    parser.add_argument('--excel', help="rebuild the monthly Excel workbooks of changed months in this directory")
+    parser.add_argument('--run-reports', help="write a run report for every import into this directory")
+    parser.add_argument('--interval', type=float, default=POLL_SECONDS, help="seconds between polls")
+    parser.add_argument('--once', action='store_true', help="import what is in the folder now and exit")
+    args = parser.parse_args()
+
+    watcher = FolderWatcher(args.folder, args.ledger, args.rules, args.excel, args.run_reports)
+    if args.once:
+        # Two looks at the folder, SETTLE_SECONDS apart, so only finished files are imported
+        watcher.scan()
+        time.sleep(SETTLE_SECONDS)
+        print(f"{watcher.scan()} statements imported")
+    else:
+        watcher.watch(args.interval)
+
+
+if __name__ == "__main__":
+    main()